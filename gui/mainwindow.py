@@ -190,17 +190,18 @@ class Ui_MainWindow(object):
         self.label_4.setAlignment(QtCore.Qt.AlignCenter)
         self.label_4.setObjectName("label_4")
         self.verticalLayout.addWidget(self.label_4)
-        self.mcuFilesListView = QtWidgets.QListView(self.verticalLayoutWidget)
+        self.mcuFilesTreeView = QtWidgets.QTreeView(self.verticalLayoutWidget)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.MinimumExpanding, QtWidgets.QSizePolicy.Expanding)
         sizePolicy.setHorizontalStretch(0)
         sizePolicy.setVerticalStretch(0)
-        sizePolicy.setHeightForWidth(self.mcuFilesListView.sizePolicy().hasHeightForWidth())
-        self.mcuFilesListView.setSizePolicy(sizePolicy)
-        self.mcuFilesListView.setMinimumSize(QtCore.QSize(150, 0))
-        self.mcuFilesListView.setMaximumSize(QtCore.QSize(16777215, 16777215))
-        self.mcuFilesListView.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
-        self.mcuFilesListView.setObjectName("mcuFilesListView")
-        self.verticalLayout.addWidget(self.mcuFilesListView)
+        sizePolicy.setHeightForWidth(self.mcuFilesTreeView.sizePolicy().hasHeightForWidth())
+        self.mcuFilesTreeView.setSizePolicy(sizePolicy)
+        self.mcuFilesTreeView.setMinimumSize(QtCore.QSize(150, 0))
+        self.mcuFilesTreeView.setMaximumSize(QtCore.QSize(16777215, 16777215))
+        self.mcuFilesTreeView.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.mcuFilesTreeView.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.mcuFilesTreeView.setObjectName("mcuFilesTreeView")
+        self.verticalLayout.addWidget(self.mcuFilesTreeView)
         self.listButton = QtWidgets.QPushButton(self.verticalLayoutWidget)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Fixed)
         sizePolicy.setHorizontalStretch(0)
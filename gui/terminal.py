@@ -53,6 +53,9 @@ class Ui_TerminalDialog(object):
         self.autoscrollCheckBox = QtWidgets.QCheckBox(self.verticalLayoutWidget_3)
         self.autoscrollCheckBox.setObjectName("autoscrollCheckBox")
         self.horizontalLayout_2.addWidget(self.autoscrollCheckBox)
+        self.searchLineEdit = QtWidgets.QLineEdit(self.verticalLayoutWidget_3)
+        self.searchLineEdit.setObjectName("searchLineEdit")
+        self.horizontalLayout_2.addWidget(self.searchLineEdit)
         spacerItem = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
         self.horizontalLayout_2.addItem(spacerItem)
         self.clearButton = QtWidgets.QPushButton(self.verticalLayoutWidget_3)
@@ -170,6 +173,7 @@ class Ui_TerminalDialog(object):
         _translate = QtCore.QCoreApplication.translate
         TerminalDialog.setWindowTitle(_translate("TerminalDialog", "Terminal"))
         self.autoscrollCheckBox.setText(_translate("TerminalDialog", "Autoscroll"))
+        self.searchLineEdit.setPlaceholderText(_translate("TerminalDialog", "Search"))
         self.clearButton.setText(_translate("TerminalDialog", "Clear"))
         self.sendButton.setText(_translate("TerminalDialog", "Send"))
         self.groupBox.setTitle(_translate("TerminalDialog", "Control"))
@@ -1,36 +1,53 @@
-#V2
+#V7
 import sys
-import time
-from ubinascii import b2a_base64
+from ubinascii import b2a_base64, crc32
 
 
-def _read_timeout(cnt, timeout_ms=2000):
-    time_support = "ticks_ms" in dir(time)
-    s_time = time.ticks_ms() if time_support else 0
-    data = sys.stdin.read(cnt)
-    if len(data) != cnt or (time_support and time.ticks_diff(time.ticks_ms(), s_time) > timeout_ms):
-        return None
-    return data
+def _escape(d):
+    # Order matters, escape character itself has to be escaped first
+    return d.replace(b"\x10", b"\x10P").replace(b"\x03", b"\x10C").replace(b"\x04", b"\x10D")\
+        .replace(b"\x05", b"\x10E").replace(b"#", b"\x10c")
+
+
+def _response():
+    # Skip everything until start of response
+    while sys.stdin.read(1) != "#":
+        pass
+    r = sys.stdin.read(5)
+    try:
+        if crc32(r[:3].encode()) & 0xff != int(r[3:5], 16):
+            return None, None
+        return r[0], int(r[1:3])
+    except ValueError:
+        return None, None
 
 
 def _download():
-    if _read_timeout(3) != "###":
+    if sys.stdin.read(3) != "###":
         return
+    # Raw transfer writes bytes directly, only REPL control characters are escaped
+    out = sys.stdout.buffer if raw_transfer else sys.stdout
+    seq = 0
     with open("file_name.py", "rb") as f:
+        chunk = f.read(48)
         while True:
-            chunk = f.read(48)
-            if not chunk:
-                break
-            chunk = b2a_base64(chunk).strip()
-            if isinstance(chunk, bytes):
-                chunk = chunk.decode("ascii")
-            cl = len(chunk)
-            x = sys.stdout.write("".join(["#", "0" if cl < 10 else "", str(cl), chunk]))
-            ack = _read_timeout(2)
-            if not ack or ack != "#1":
-                return
-
-        # Mark end
-        x = sys.stdout.write("#00")
+            # Empty chunk marks end of file
+            if raw_transfer:
+                data = _escape(chunk)
+            else:
+                data = b2a_base64(chunk).strip()
+                if isinstance(data, bytes):
+                    data = data.decode("ascii")
+            # Checksum includes chunk number, so that chunk can't end up in wrong place
+            header = "#%02d%02d%08x" % (seq, len(data), crc32(chunk, seq))
+            x = out.write(header.encode("ascii") if raw_transfer else header)
+            x = out.write(data)
+            code, n = _response()
+            # Anything else than request for next chunk (ACK) means that this one has to be sent again
+            if code == "1" and n == (seq + 1) % 100:
+                if not chunk:
+                    break
+                seq = n
+                chunk = f.read(48)
 
 _download()
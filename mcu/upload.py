@@ -1,38 +1,183 @@
-#V2
+#V7
+import os
 import sys
-import time
-from ubinascii import a2b_base64
+from ubinascii import a2b_base64, crc32
 
+# Data that were read but belong to next frame
+_rest = None
 
-def _read_timeout(cnt, timeout_ms=2000):
-    time_support = "ticks_ms" in dir(time)
-    s_time = time.ticks_ms() if time_support else 0
-    data = sys.stdin.read(cnt)
-    if len(data) != cnt or (time_support and time.ticks_diff(time.ticks_ms(), s_time) > timeout_ms):
-        return None
+
+def _read(stream, cnt):
+    global _rest
+    if not _rest:
+        return stream.read(cnt)
+    data, _rest = _rest[:cnt], _rest[cnt:]
+    if len(data) < cnt:
+        data += stream.read(cnt - len(data))
     return data
 
 
+def _unread(data):
+    global _rest
+    _rest = data + _rest if _rest else data
+
+
+def _unescape(d):
+    # Order matters, escape character itself has to be restored last
+    return d.replace(b"\x10C", b"\x03").replace(b"\x10D", b"\x04").replace(b"\x10E", b"\x05")\
+        .replace(b"\x10c", b"#").replace(b"\x10P", b"\x10")
+
+
+def _reply(code, seq, fmt="%s%02d"):
+    r = fmt % (code, seq)
+    # Short checksum protects reply against corruption too
+    x = sys.stdout.write("#%s%02x" % (r, crc32(r.encode()) & 0xff))
+
+
+def _frame(inp, mark):
+    # Skip everything until start of frame, this resynchronizes stream after corrupted data.
+    # Frame mark can't appear anywhere else, it's escaped in raw data and base64 doesn't use it.
+    while _read(inp, 1) != mark:
+        pass
+    h = _read(inp, 12)
+    i = h.find(mark)
+    if i >= 0:
+        _unread(h[i:])
+        return None, None
+    try:
+        seq, cnt, crc = int(h[0:2]), int(h[2:4]), int(h[4:12], 16)
+    except ValueError:
+        return None, None
+    if seq < 0 or cnt < 0:
+        return None, None
+    d = _read(inp, cnt)
+    i = d.find(mark)
+    if i >= 0:
+        _unread(d[i:])
+        return seq, None
+    try:
+        d = _unescape(d) if raw_transfer else a2b_base64(d)
+    except ValueError:
+        return seq, None
+    # Checksum includes chunk number, so that chunk can't end up in wrong place
+    return seq, d if crc32(d, seq) == crc else None
+
+
+def _finish(tmp, name):
+    try:
+        os.remove(name)
+    except OSError:
+        pass
+    os.rename(tmp, name)
+
+
+class _Batch:
+    # Splits stream of records (header with size and name followed by data) into files
+
+    def __init__(self):
+        self.head = b""
+        self.f = None
+        self.name = None
+        self.left = 0
+
+    def write(self, d):
+        while d:
+            if self.f is None:
+                i = d.find(b"\n")
+                if i < 0:
+                    self.head += d
+                    return
+                h, d = self.head + d[:i], d[i + 1:]
+                self.head = b""
+                size, name = h.split(b" ", 1)
+                self.name = name.decode()
+                self.left = int(size)
+                self.f = open(self.name + ".part", "wb")
+            n = min(self.left, len(d))
+            x = self.f.write(d[:n])
+            d = d[n:]
+            self.left -= n
+            if not self.left:
+                self.f.close()
+                self.f = None
+                _finish(self.name + ".part", self.name)
+
+    def complete(self):
+        return self.f is None and not self.head
+
+    def close(self):
+        # Incomplete file is useless, it can't be resumed
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            os.remove(self.name + ".part")
+
+
 def _upload():
     suc = False
-    with open("file_name.py", "wb") as f:
+    # Raw transfer reads bytes directly, only REPL control characters are escaped
+    inp = sys.stdin.buffer if raw_transfer else sys.stdin
+    mark = b"#" if raw_transfer else "#"
+    # Number of next chunk to be written (modulo 100) and chunks that arrived before it
+    expected = 0
+    pending = {}
+    nacked = set()
+    if batch:
+        f = _Batch()
+    else:
+        # Data are written to temporary file which is renamed once complete,
+        # so interrupted upload can continue where it ended
+        tmp = "file_name.py" + ".part"
+        mode = "wb"
+        if resume_offset:
+            try:
+                size = os.stat(tmp)[6]
+                mode = "ab"
+            except OSError:
+                size = 0
+            _reply("O", size, "%s%08x")
+        f = open(tmp, mode)
+    try:
         while True:
-            d = _read_timeout(3)
-            if not d or d[0] != "#":
-                x = sys.stdout.write("#2")
+            seq, d = _frame(inp, mark)
+            if seq is None:
+                # Frame was lost, it will be requested once gap is detected
+                continue
+            dist = (seq - expected) % 100
+            if dist >= 50:
+                # Chunk was already written, confirm again in case ACK was lost
+                _reply("1", expected)
+            elif d is None:
+                _reply("5", seq)
+                nacked.add(seq)
+            elif not d:
+                # End mark, sent only after all chunks were confirmed
+                suc = dist == 0 and not pending and (not batch or f.complete())
                 break
-            cnt = int(d[1:3])
-            if cnt == 0:
-                suc = True
-                break
-            d = _read_timeout(cnt)
-            if d:
-                x = f.write(a2b_base64(d))
-                x = sys.stdout.write("#1")
+            elif dist == 0:
+                x = f.write(d)
+                expected = (expected + 1) % 100
+                while expected in pending:
+                    x = f.write(pending.pop(expected))
+                    expected = (expected + 1) % 100
+                nacked.clear()
+                # ACK is cumulative, it carries number of next expected chunk
+                _reply("1", expected)
             else:
-                x = sys.stdout.write("#3")
-                break
-    x = sys.stdout.write("#0" if suc else "#4")
+                pending[seq] = d
+                # Request chunks that are missing in between
+                for i in range(dist):
+                    s = (expected + i) % 100
+                    if s not in pending and s not in nacked:
+                        _reply("5", s)
+                        nacked.add(s)
+    finally:
+        f.close()
+    if suc and not batch:
+        _finish(tmp, "file_name.py")
+    # Nothing would answer repeated end mark, so make sure that result gets through
+    for i in range(3):
+        _reply("0" if suc else "4", expected)
 
 
 _upload()
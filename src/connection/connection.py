@@ -1,19 +1,300 @@
+import codecs
+import hashlib
+import os
+import posixpath
+import re
+import struct
 import time
-from threading import Lock, Thread
+import traceback
+import zlib
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Thread, current_thread
 
+from src.logic.file_transfer import FileSource, MemorySink
+from src.logic.remote_file import RemoteFile
 from src.utility.exceptions import OperationError
+from src.utility.settings import Settings
 
 
 class Connection:
+    # Uploads that were interrupted, maps remote name to content digest and confirmed offset.
+    # Shared by all connections, so that upload can be resumed after reconnecting.
+    _partial_uploads = {}
+
+    # Compressed files are uploaded here first and then inflated into target file
+    COMPRESSED_TEMP_NAME = "__transfer.z"
+    # Small window keeps memory needed for decompression on device low (2^10 bytes)
+    COMPRESSION_WBITS = 10
+    # Bytes per second that even slow boards manage when copying files in flash
+    DEVICE_FILE_RATE = 16 * 1024
+
+    _DETECT_DECOMPRESSOR_CODE = "\n".join([
+        "try:",
+        "  import deflate",
+        "  print(\"#Z\", \"deflate\")",
+        "except ImportError:",
+        "  try:",
+        "    import uzlib",
+        "    print(\"#Z\", \"uzlib\")",
+        "  except ImportError:",
+        "    print(\"#Z\", \"none\")",
+        ""])
+
+    # Content is inflated into temporary file, so that failure doesn't leave truncated target behind
+    _DECOMPRESS_CODE = "\n".join([
+        "import os, {module}",
+        "try:",
+        "  with open({temp}, \"rb\") as i, open({part}, \"wb\") as o:",
+        "    d = {stream}",
+        "    b = bytearray(256)",
+        "    while True:",
+        "      n = d.readinto(b)",
+        "      if not n:",
+        "        break",
+        "      x = o.write(b[:n])",
+        "  try:",
+        "    os.remove({name})",
+        "  except OSError:",
+        "    pass",
+        "  os.rename({part}, {name})",
+        "  print(\"#D\", \"ok\")",
+        "except:",
+        "  try:",
+        "    os.remove({part})",
+        "  except OSError:",
+        "    pass",
+        "finally:",
+        "  os.remove({temp})",
+        ""])
+
+    _DECOMPRESS_STREAMS = {
+        "deflate": "deflate.DeflateIO(i, deflate.ZLIB)",
+        "uzlib": "uzlib.DecompIO(i, {})".format(COMPRESSION_WBITS),
+    }
+
+    # Prints one record per entry, path is last so that it can contain any characters
+    _LIST_FILES_CODE = "\n".join([
+        "import os",
+        "def _ls(d, r):",
+        "  if hasattr(os, \"ilistdir\"):",
+        "    es = os.ilistdir(d)",
+        "  else:",
+        "    es = ((n, os.stat(d + \"/\" + n)[0]) for n in os.listdir(d))",
+        "  for e in es:",
+        "    p = e[0] if d == \".\" else d + \"/\" + e[0]",
+        "    t = e[1] & 0x4000",
+        "    print(\"#F\", \"d\" if t else \"f\", 0 if t else (e[3] if len(e) > 3 and e[3] >= 0 else os.stat(p)[6]), p)",
+        "    if t and r:",
+        "      _ls(p, r)",
+        "_ls({directory}, {recursive})",
+        "del _ls",
+        ""])
+
+    _HASH_FILES_CODE = "\n".join([
+        "import ubinascii",
+        "try:",
+        "  import uhashlib as hashlib",
+        "except ImportError:",
+        "  import hashlib",
+        "for n in {names}:",
+        "  try:",
+        "    h = hashlib.sha256()",
+        "    with open(n, \"rb\") as f:",
+        "      while True:",
+        "        b = f.read(256)",
+        "        if not b:",
+        "          break",
+        "        h.update(b)",
+        "    print(\"#H\", ubinascii.hexlify(h.digest()).decode(), n)",
+        "  except OSError:",
+        "    print(\"#H\", \"-\", n)",
+        ""])
+
+    _REMOVE_FILES_CODE = "\n".join([
+        "import os",
+        "def _rm(p, r):",
+        "  if os.stat(p)[0] & 0x4000:",
+        "    if r:",
+        "      for n in os.listdir(p):",
+        "        _rm(p + \"/\" + n, r)",
+        "    os.rmdir(p)",
+        "  else:",
+        "    os.remove(p)",
+        "for p in {names}:",
+        "  try:",
+        "    _rm(p, {recursive})",
+        "    print(\"#R\", 1, p)",
+        "  except OSError:",
+        "    print(\"#R\", 0, p)",
+        "del _rm",
+        ""])
+
+    # Existing directory is fine, anything else in the way is reported and stops the rest
+    _MAKE_DIRS_CODE = "\n".join([
+        "import os",
+        "for d in {dirs}:",
+        "  try:",
+        "    os.mkdir(d)",
+        "  except OSError:",
+        "    try:",
+        "      t = os.stat(d)[0] & 0x4000",
+        "    except OSError:",
+        "      t = 0",
+        "    if not t:",
+        "      print(\"#M\", d)",
+        "      break",
+        ""])
+
+    _RAW_REPL_PROMPT = b"raw REPL; CTRL-B to exit\r\n>"
+
     def __init__(self, terminal=None):
         self._terminal = terminal
-        self._reader_running = False
-        self._auto_read_enabled = True
-        self._auto_reader_lock = Lock()
+        # All communication with device happens in single I/O thread, other threads submit commands to it
+        self._io_thread = None
+        self._io_running = False
+        # Set once transport failed in I/O thread, commands are then rejected with OperationError,
+        # same as when they are submitted while I/O thread doesn't run
+        self._io_failed = False
+        self._commands = Queue()
+        self._decompressor = None
+        # Whether device supports raw-paste mode, None until it's known
+        self._raw_paste = None
+        # Data that were read but belong to next reader
+        self._unread = b""
+        # Keeps bytes of characters that are split between reads until the rest arrives
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # Entries of listed device directories, maps directory path to entries by their path.
+        # Only accessed from I/O thread.
+        self._remote_dirs = {}
+        # Directories created by uploads, their parent doesn't have to be listed
+        self._created_dirs = set()
+        # End of previous terminal output, so that reset message split between reads is found
+        self._output_tail = ""
 
     def is_connected(self):
         raise NotImplementedError()
 
+    def _start_io_thread(self):
+        self._io_thread = Thread(target=self._io_thread_routine)
+        self._io_running = True
+        self._io_thread.start()
+
+    def _stop_io_thread(self):
+        if self._io_thread is not None and self._io_thread.is_alive():
+            self._io_running = False
+            self._wake_io_thread()
+            self._io_thread.join()
+        # Nothing will run commands that are still waiting
+        while True:
+            try:
+                future, _, _ = self._commands.get_nowait()
+            except Empty:
+                break
+            future.cancel()
+
+    def _wake_io_thread(self):
+        """Interrupts waiting for terminal output, so that new command starts immediately"""
+        pass
+
+    def _on_io_thread(self):
+        """Returns whether I/O can be done directly from current thread"""
+        return not self._io_running or current_thread() is self._io_thread
+
+    def submit(self, function, *args):
+        """Queues function for I/O thread and returns future of its result, caller has to check the result"""
+        future = Future()
+        self._commands.put((future, function, args))
+        if self._io_failed or not self._io_running:
+            # Nothing would run the command, connection failed or was closed
+            self._fail_pending()
+        else:
+            self._wake_io_thread()
+        return future
+
+    def _submit(self, function, *args):
+        """Queues function for I/O thread, its exception is printed as nobody waits for the result"""
+        future = self.submit(function, *args)
+        future.add_done_callback(self._report_failure)
+        return future
+
+    def _report_failure(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        e = future.exception()
+        # Commands rejected after connection failed were already reported with the failure,
+        # ones submitted after it was closed are expected to fail
+        if not ((self._io_failed or not self._io_running) and isinstance(e, OperationError)):
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    def _submit_transfer(self, transfer, function, *args, sink=None):
+        """Queues transfer job, transfer is marked as failed if job doesn't end it itself.
+
+        That happens when job is dropped on disconnect, rejected after connection failed or raises.
+        """
+        future = self._submit(function, *args)
+        future.add_done_callback(lambda f: Connection._end_abandoned_transfer(f, transfer, sink))
+        return future
+
+    @staticmethod
+    def _end_abandoned_transfer(future, transfer, sink):
+        if transfer.finished or transfer.error or transfer.cancelled:
+            return
+        if sink is not None:
+            sink.discard()
+        if future.cancelled():
+            transfer.mark_error("Connection was closed.")
+        elif isinstance(future.exception(), OperationError):
+            transfer.mark_error("Connection to device failed.")
+        else:
+            transfer.mark_error("Transfer stopped unexpectedly.")
+
+    def _fail_pending(self):
+        """Rejects all commands waiting for I/O thread"""
+        while True:
+            try:
+                future, _, _ = self._commands.get_nowait()
+            except Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(OperationError())
+
+    def _call(self, function, *args):
+        """Runs function in I/O thread and waits for its result"""
+        if self._on_io_thread():
+            return function(*args)
+        return self.submit(function, *args).result()
+
+    def _post(self, function, *args):
+        """Runs function in I/O thread without waiting for it"""
+        if self._on_io_thread():
+            function(*args)
+        else:
+            self._submit(function, *args)
+
+    def _io_thread_routine(self):
+        while self._io_running:
+            try:
+                future, function, args = self._commands.get_nowait()
+            except Empty:
+                # Output that isn't response to any command goes to terminal,
+                # waiting for it is interrupted when new command comes
+                try:
+                    self.read_line()
+                except Exception:
+                    # Device was most likely unplugged or connection dropped
+                    traceback.print_exc()
+                    self._io_failed = True
+                    self._fail_pending()
+                    return
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
     def disconnect(self):
         raise NotImplementedError()
 
@@ -23,31 +304,85 @@ class Connection:
     def read_all(self):
         raise NotImplementedError()
 
+    def _to_terminal(self, data):
+        """Decodes device output and passes it to terminal, returns decoded text"""
+        text = self._decoder.decode(data)
+        if "soft reboot" in self._output_tail + text:
+            # Boot scripts could have changed files
+            self._remote_dirs = {}
+            self._created_dirs = set()
+        self._output_tail = text[-16:]
+        if text and self._terminal is not None:
+            self._terminal.add(text)
+        return text
+
     def read_junk(self):
         self.read_all()
 
-    def read_one_byte(self):
+    def _read_available(self):
+        """Returns data that already arrived, waits for them only shortly if there are none"""
         raise NotImplementedError()
 
+    def _read_chunk(self):
+        if self._unread:
+            data, self._unread = self._unread, b""
+            return data
+        return self._read_available()
+
+    def _take_unread(self):
+        data, self._unread = self._unread, b""
+        return data
+
     def read_to_next_prompt(self, timeout=5.0):
-        ret = b""
+        return self._read_until(b">>> ", timeout).decode("utf-8", errors="replace")
+
+    def _read_until(self, ending, timeout):
+        """Reads data up to and including ending, anything after it is kept for next reader"""
+        ret = bytearray()
         t_start = time.time()
-        while len(ret) < 4 or ret[-4:] != b">>> ":
+        # Only newly read data (and possible start of ending before them) are searched
+        searched = 0
+        while True:
+            idx = ret.find(ending, max(0, searched - len(ending) + 1))
+            if idx >= 0:
+                end = idx + len(ending)
+                self._unread = bytes(ret[end:]) + self._unread
+                return bytes(ret[:end])
+            searched = len(ret)
             if (time.time() - t_start) >= timeout:
                 raise TimeoutError()
-            ret += self.read_one_byte()
-        return ret.decode("utf-8", errors="replace")
+            ret += self._read_chunk()
+
+    def _read_count(self, count, timeout):
+        ret = bytearray()
+        t_start = time.time()
+        while len(ret) < count:
+            if (time.time() - t_start) >= timeout:
+                raise TimeoutError()
+            ret += self._read_chunk()
+        self._unread = bytes(ret[count:]) + self._unread
+        return bytes(ret[:count])
+
+    def send_raw(self, binary):
+        """Sends data without any delay, unlike send_bytes"""
+        raise NotImplementedError()
 
     def send_line(self, line_text, ending):
         raise NotImplementedError()
 
     def send_character(self, char):
+        self._post(self._send_character, char)
+
+    def _send_character(self, char):
         raise NotImplementedError()
 
     def send_bytes(self, binary):
         raise NotImplementedError()
 
     def send_block(self, text):
+        if not self._on_io_thread():
+            self._submit(self.send_block, text)
+            return
         lines = text.split("\n")
         if len(lines) == 1:
             self.send_line(lines[0], "\r")
@@ -58,27 +393,290 @@ class Connection:
             self.send_end_paste()
 
     def run_file(self, file_name, globals_init=""):
+        if not self._on_io_thread():
+            self._submit(self.run_file, file_name, globals_init)
+            return
         self.send_start_paste()
         if globals_init:
             self.send_line(globals_init, "\r")
-        self.send_line("with open(\"{}\") as f:".format(file_name), "\r")
+        self.send_line("with open({}) as f:".format(repr(file_name)), "\r")
         self.send_line("    exec(f.read(), globals())", "\r")
         self.send_end_paste()
 
+    def _raw_exec_start(self, code, timeout=5.0):
+        """Sends code to raw REPL and starts it, doesn't wait for its output.
+
+        Raw-paste mode is used if device supports it, code is then sent as fast
+        as device flow control allows. Runs in I/O thread.
+        """
+        if isinstance(code, str):
+            code = code.encode("utf-8")
+        # Interrupt anything that runs and enter raw REPL
+        self.send_raw(b"\r\x03\x03")
+        self.send_raw(b"\r\x01")
+        self._read_until(Connection._RAW_REPL_PROMPT, timeout)
+
+        if self._raw_paste is not False:
+            self.send_raw(b"\x05A\x01")
+            resp = self._read_count(2, timeout)
+            if resp == b"R\x01":
+                self._raw_paste = True
+                self._raw_paste_write(code, timeout)
+                return
+            if resp != b"R\x00":
+                # Firmware doesn't know raw-paste, it took the request as new raw REPL entry
+                self._read_until(Connection._RAW_REPL_PROMPT[2:], timeout)
+            self._raw_paste = False
+
+        for i in range(0, len(code), 256):
+            self.send_raw(code[i:i + 256])
+            time.sleep(0.01)
+        self.send_raw(b"\x04")
+        if self._read_count(2, timeout) != b"OK":
+            raise OperationError()
+
+    def _raw_paste_write(self, code, timeout):
+        # Device allows to send window of data and then requests another one with \x01
+        (window,) = struct.unpack("<H", self._read_count(2, timeout))
+        remaining = window
+        i = 0
+        while i < len(code):
+            if remaining == 0:
+                resp = self._read_count(1, timeout)
+                if resp == b"\x01":
+                    remaining += window
+                elif resp == b"\x04":
+                    # Device ended paste prematurely
+                    self.send_raw(b"\x04")
+                    raise OperationError()
+                continue
+            data = code[i:i + remaining]
+            self.send_raw(data)
+            remaining -= len(data)
+            i += len(data)
+        self.send_raw(b"\x04")
+        self._read_until(b"\x04", timeout)
+
+    def _raw_exec_output(self, timeout=5.0):
+        """Waits until code started in raw REPL ends, returns its standard and error output"""
+        out = self._read_until(b"\x04", timeout)[:-1]
+        err = self._read_until(b"\x04", timeout)[:-1]
+        self._read_until(b">", timeout)
+        return out.decode("utf-8", errors="replace"), err.decode("utf-8", errors="replace")
+
+    def _exit_raw_repl(self):
+        self.send_raw(b"\x02")
+        try:
+            self.read_to_next_prompt(1.0)
+        except TimeoutError:
+            pass
+
+    @staticmethod
+    def _file_timeout(size):
+        """Returns timeout for command that copies or writes size bytes on device"""
+        return 5.0 + size / Connection.DEVICE_FILE_RATE
+
+    def execute(self, code, timeout=5.0):
+        """Runs code in raw REPL, returns its standard and error output"""
+        return self._call(self._execute, code, timeout)
+
+    def _execute(self, code, timeout):
+        try:
+            self._raw_exec_start(code, timeout)
+            return self._raw_exec_output(timeout)
+        finally:
+            self._exit_raw_repl()
+
+    def list_tree(self, directory="", recursive=True, timeout=10.0):
+        """Returns RemoteFile for each entry in directory (working directory if empty) and, if recursive,
+        its subdirectories.
+
+        :raises OperationError: If listing failed
+        """
+        code = Connection._LIST_FILES_CODE.format(directory=repr(directory or "."), recursive=recursive)
+        try:
+            out, err = self.execute(code, timeout)
+        except TimeoutError:
+            raise OperationError()
+        if err:
+            raise OperationError()
+        # Size that is still unknown (negative) is kept as 0, so that entry isn't lost
+        return [RemoteFile(path, kind == "d", max(0, int(size)))
+                for kind, size, path in re.findall(r"^#F ([df]) (-?\d+) (.+?)\r?$", out, re.MULTILINE)]
+
+    def list_files(self):
+        """Returns names of entries in device working directory"""
+        return [entry.path for entry in self.list_tree(recursive=False)]
+
+    def remote_directory(self, directory="", refresh=False):
+        """Returns entries of device directory (working directory if empty) sorted by path.
+
+        Listed directories are cached and updated by transfers and removals, device is
+        listed again only when refresh is requested, directory wasn't listed yet or
+        device was reset. Refresh drops also cached subdirectories.
+
+        :raises OperationError: If listing failed
+        """
+        return self._call(self._cached_directory, directory, refresh)
+
+    def _cached_directory(self, directory, refresh):
+        if refresh:
+            prefix = directory + "/" if directory else ""
+            for cached in [d for d in self._remote_dirs if d == directory or d.startswith(prefix)]:
+                del self._remote_dirs[cached]
+        if directory not in self._remote_dirs:
+            self._remote_dirs[directory] = {entry.path: entry
+                                            for entry in self.list_tree(directory, recursive=False)}
+        return sorted(self._remote_dirs[directory].values(), key=lambda entry: entry.path)
+
+    def _cache_file_written(self, file_name, size):
+        self._cache_entry_added(RemoteFile(file_name, False, size))
+
+    def _cache_entry_added(self, entry):
+        path = posixpath.normpath(entry.path) if entry.path else ""
+        if path == ".":
+            return
+        if path.startswith("/") or path == ".." or path.startswith("../"):
+            # Listing paths are relative to working directory, where this ends up isn't known
+            self._remote_dirs.clear()
+            return
+        entry = RemoteFile(path, entry.is_dir, entry.size)
+        # Directories have to exist already, but they could have been created after listing
+        while entry.path:
+            entries = self._remote_dirs.get(entry.parent)
+            if entries is not None:
+                if entry.is_dir and entry.path in entries:
+                    break
+                entries[entry.path] = entry
+            entry = RemoteFile(entry.parent, True, 0)
+
+    def _cache_file_removed(self, file_name, removed=True):
+        """Drops cached content of removed path, entry itself is dropped only if it was removed"""
+        if removed:
+            entries = self._remote_dirs.get(RemoteFile(file_name, False, 0).parent)
+            if entries is not None:
+                entries.pop(file_name, None)
+        for path in [path for path in self._remote_dirs if path == file_name or path.startswith(file_name + "/")]:
+            del self._remote_dirs[path]
+        self._created_dirs = {path for path in self._created_dirs
+                              if path != file_name and not path.startswith(file_name + "/")}
+
     def remove_file(self, file_name):
+        if not self.remove_files([file_name]).get(file_name):
+            raise OperationError()
+
+    def remove_files(self, file_names, recursive=False, timeout=30.0):
+        """Removes files and empty directories in single device command, returns success for each path.
+
+        With recursive, directories are removed together with all their content.
+
+        :raises OperationError: If command couldn't be run on device
+        """
+        return self._call(self._remove_files, file_names, recursive, timeout)
+
+    def _remove_files(self, file_names, recursive, timeout):
         success = True
-        # Prevent echo
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
-        self.send_line("import os; os.remove(\"{}\")".format(file_name))
+        ret = ""
         try:
-            self.read_to_next_prompt()
-        except TimeoutError:
+            code = Connection._REMOVE_FILES_CODE.format(names=repr(list(file_names)), recursive=recursive)
+            ret, _ = self.execute(code, timeout)
+        except (TimeoutError, OperationError):
             success = False
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
-        if not success:
+
+        results = {name: ok == "1" for ok, name in re.findall(r"^#R ([01]) (.+?)\r?$", ret, re.MULTILINE)}
+        # Content of directory could have been partially removed even if it failed
+        for name in file_names:
+            self._cache_file_removed(name, results.get(name, False))
+        if not success or not results:
+            raise OperationError()
+        return results
+
+    def _remote_decompressor(self):
+        """Returns name of module that can inflate data on device or empty string if there is none"""
+        if self._decompressor is None:
+            try:
+                resp, _ = self.execute(Connection._DETECT_DECOMPRESSOR_CODE)
+            except (TimeoutError, OperationError):
+                return ""
+            match = re.search(r"#Z (\w+)", resp)
+            self._decompressor = match.group(1) if match and match.group(1) != "none" else ""
+        return self._decompressor
+
+    def _compress_for_upload(self, file_name, content):
+        """Returns remote name and content that should be uploaded and whether content is compressed.
+
+        Falls back to plain content when compression is disabled, not supported by
+        firmware or wouldn't make the content smaller.
+        """
+        if not Settings().compress_transfer or not content or not self._remote_decompressor():
+            return file_name, content, False
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, Connection.COMPRESSION_WBITS)
+        compressed = compressor.compress(content) + compressor.flush()
+        if len(compressed) >= len(content):
+            return file_name, content, False
+
+        return Connection.COMPRESSED_TEMP_NAME, compressed, True
+
+    def _decompress_uploaded(self, file_name, size):
+        """Inflates previously uploaded compressed content into file, size is size of inflated content"""
+        module = self._remote_decompressor()
+        # Temporary file of interrupted upload is replaced
+        self._forget_partial_upload(file_name)
+        try:
+            resp, _ = self.execute(Connection._DECOMPRESS_CODE.format(
+                module=module,
+                temp=repr(Connection.COMPRESSED_TEMP_NAME),
+                part=repr(file_name + ".part"),
+                name=repr(file_name),
+                stream=Connection._DECOMPRESS_STREAMS[module]), self._file_timeout(size))
+        except (TimeoutError, OperationError):
+            return False
+        return re.search(r"#D ok", resp) is not None
+
+    def hash_files(self, file_names, timeout=30.0):
+        """Returns SHA-256 hex digests of remote files in single request.
+
+        Files that don't exist are missing in returned dictionary.
+        """
+        if not file_names:
+            return {}
+        return self._call(self._hash_files, file_names, timeout)
+
+    def _hash_files(self, file_names, timeout):
+        success = True
+        ret = ""
+        try:
+            ret, _ = self.execute(Connection._HASH_FILES_CODE.format(names=repr(list(file_names))), timeout)
+        except (TimeoutError, OperationError):
+            success = False
+
+        results = re.findall(r"^#H ([0-9a-f]{64}|-) (.+?)\r?$", ret, re.MULTILINE)
+        if not success or not results:
             raise OperationError()
+        return {name: digest for digest, name in results if digest != "-"}
+
+    @staticmethod
+    def _resume_offset(remote_name, content):
+        """Returns confirmed offset of interrupted upload of the same content or 0 if there is none"""
+        if remote_name not in Connection._partial_uploads:
+            return 0
+        digest, offset = Connection._partial_uploads[remote_name]
+        if digest != hashlib.sha256(content).digest():
+            del Connection._partial_uploads[remote_name]
+            return 0
+        return offset
+
+    @staticmethod
+    def _record_partial_upload(remote_name, content, offset):
+        if offset > 0:
+            Connection._partial_uploads[remote_name] = (hashlib.sha256(content).digest(), offset)
+        else:
+            Connection._forget_partial_upload(remote_name)
+
+    @staticmethod
+    def _forget_partial_upload(remote_name):
+        Connection._partial_uploads.pop(remote_name, None)
 
     def send_start_paste(self):
         self.send_character("\5")
@@ -89,53 +687,119 @@ class Connection:
     def send_kill(self):
         self.send_character("\3")
 
-    def _reader_thread_routine(self):
-        self._reader_running = True
-        while self._reader_running:
-            self._auto_reader_lock.acquire()
-            x = ""
-            if self._auto_read_enabled:
-                x = self.read_line()
-            self._auto_reader_lock.release()
-            time.sleep(0.1 if not x else 0)
-
     @staticmethod
-    def _get_remote_file_name(local_file_path):
+    def _get_remote_file_name(local_file_path, root=None):
+        """Returns path relative to root or only file name if there is no root or file is outside of it"""
+        if root:
+            try:
+                relative = os.path.relpath(local_file_path, root).replace(os.sep, "/")
+            except ValueError:
+                # On Windows file and root can be on different drives
+                relative = ".."
+            if relative != ".." and not relative.startswith("../"):
+                return relative
         return local_file_path.rsplit("/", 1)[1]
 
-    def list_files(self):
-        raise NotImplementedError()
+    def _known_dir(self, path):
+        """Returns whether directory is known to exist from cached listing or from previous upload"""
+        if path in self._remote_dirs or path in self._created_dirs:
+            return True
+        entry = self._remote_dirs.get(RemoteFile(path, True, 0).parent, {}).get(path)
+        return entry is not None and entry.is_dir
+
+    def _make_remote_dirs(self, file_names, transfer):
+        """Creates all missing parent directories of files in single command, marks error on failure"""
+        dirs = set()
+        for name in file_names:
+            entry = RemoteFile(name, False, 0)
+            while entry.parent and not self._known_dir(entry.parent):
+                dirs.add(entry.parent)
+                entry = RemoteFile(entry.parent, True, 0)
+        if not dirs:
+            return True
+        # Parents sort before their subdirectories
+        dirs = sorted(dirs)
+        try:
+            out, err = self.execute(Connection._MAKE_DIRS_CODE.format(dirs=repr(dirs)))
+        except (TimeoutError, OperationError):
+            out, err = "", True
+        failed = re.search(r"^#M (.+?)\r?$", out, re.MULTILINE)
+        if failed:
+            transfer.mark_error("Couldn't create remote directory {}, file with that name exists.".format(
+                failed.group(1)))
+            return False
+        if err:
+            transfer.mark_error("Couldn't create remote directories.")
+            return False
+        for path in dirs:
+            self._cache_entry_added(RemoteFile(path, True, 0))
+        self._created_dirs.update(dirs)
+        return True
 
     def _write_file_job(self, remote_name, content, transfer):
         raise NotImplementedError()
 
     def write_file(self, file_name, text, transfer):
-        job_thread = Thread(target=self._write_file_job,
-                            args=(file_name, text, transfer))
-        job_thread.setDaemon(True)
-        job_thread.start()
-
-    def _write_files_job(self, local_file_paths, transfer):
-        for local_path in local_file_paths:
-            remote_name = self._get_remote_file_name(local_path)
-            with open(local_path, "rb") as f:
-                content = f.read()
-                self._write_file_job(remote_name, content, transfer)
-                if transfer.cancel_scheduled:
-                    transfer.confirm_cancel()
-                if transfer.error or transfer.cancelled:
-                    break
+        """Uploads text, returns future of the job, transfer methods below do the same"""
+        return self._submit_transfer(transfer, self._write_file_job, file_name, text, transfer)
+
+    def _upload_local_file(self, local_path, file_name, transfer):
+        try:
+            source = FileSource(local_path)
+        except IOError:
+            transfer.mark_error("Couldn't read local file.")
+            return
+        with source:
+            self._write_file_job(file_name, source.data, transfer)
+
+    def _write_local_file_job(self, local_path, file_name, transfer):
+        if self._make_remote_dirs([file_name], transfer):
+            self._upload_local_file(local_path, file_name, transfer)
+
+    def write_local_file(self, local_path, file_name, transfer):
+        """Uploads local file without reading it whole into memory, missing remote directories are created"""
+        return self._submit_transfer(transfer, self._write_local_file_job, local_path, file_name, transfer)
 
-    def write_files(self, local_file_paths, transfer):
-        job_thread = Thread(target=self._write_files_job,
-                            args=(local_file_paths, transfer))
-        job_thread.setDaemon(True)
-        job_thread.start()
+    def _write_files_job(self, local_file_paths, remote_names, transfer):
+        if not self._make_remote_dirs(remote_names, transfer):
+            return
+        for local_path, remote_name in zip(local_file_paths, remote_names):
+            self._upload_local_file(local_path, remote_name, transfer)
+            if transfer.cancel_scheduled:
+                transfer.confirm_cancel()
+            if transfer.error or transfer.cancelled:
+                break
 
-    def _read_file_job(self, file_name, transfer):
+    def write_files(self, local_file_paths, transfer, root=None):
+        """Uploads files, with root their paths relative to it are kept on device.
+
+        All missing remote directories are created at once before the first file is sent.
+        """
+        remote_names = [self._get_remote_file_name(path, root) for path in local_file_paths]
+        return self._submit_transfer(transfer, self._write_files_job, local_file_paths, remote_names, transfer)
+
+    def _read_file_job(self, file_name, transfer, sink):
         raise NotImplementedError()
 
-    def read_file(self, file_name, transfer):
-        job_thread = Thread(target=self._read_file_job, args=(file_name, transfer))
-        job_thread.setDaemon(True)
-        job_thread.start()
+    @staticmethod
+    def _finish_read(transfer, sink, success):
+        """Keeps or drops data written to sink and marks transfer accordingly"""
+        if not success:
+            sink.discard()
+            transfer.mark_error()
+            return
+        try:
+            sink.commit()
+        except OSError:
+            transfer.mark_error("Couldn't save the file. Check path and permissions.")
+            return
+        transfer.mark_finished()
+
+    def read_file(self, file_name, transfer, sink=None):
+        """Downloads file, data are written to sink as they arrive.
+
+        Without sink, data are stored in read result of transfer.
+        """
+        if sink is None:
+            sink = MemorySink(transfer.read_result)
+        return self._submit_transfer(transfer, self._read_file_job, file_name, transfer, sink, sink=sink)
@@ -0,0 +1,124 @@
+import mmap
+import re
+import tempfile
+from array import array
+from bisect import bisect_right
+from itertools import islice
+from threading import Lock
+
+
+class Scrollback:
+    """Append-only file with all terminal output.
+
+    Offset of every INDEX_STEP-th line start is indexed as output is appended, lines
+    in between are found by scanning the block. Content is read back through memory map,
+    so even very long logs don't have to be held in memory.
+    """
+
+    # Number of lines per index entry
+    INDEX_STEP = 256
+    # Size of parts in which existing log is read when it is indexed
+    READ_SIZE = 1 << 20
+
+    def __init__(self, path=None):
+        # Without path output goes to anonymous temporary file that is deleted when closed
+        self._file = open(path, "a+b") if path else tempfile.TemporaryFile()
+        self._file.seek(0, 2)
+        self._size = self._file.tell()
+        # Offsets of lines 0, INDEX_STEP, 2 * INDEX_STEP, ...
+        self._offsets = array("Q", [0])
+        self._lines = 1
+        self._mmap = None
+        self._lock = Lock()
+        if self._size:
+            self._index_existing()
+
+    def _index_existing(self):
+        self._file.seek(0)
+        base = 0
+        while base < self._size:
+            data = self._file.read(Scrollback.READ_SIZE)
+            if not data:
+                break
+            self._index(data, base)
+            base += len(data)
+        self._file.seek(0, 2)
+
+    @staticmethod
+    def _lines_pattern(count):
+        """Returns pattern matching count whole lines, so that they are skipped without Python loop"""
+        # Compiled patterns are cached by re
+        return re.compile(b"(?:[^\n]*\n){%d}" % count)
+
+    def _index(self, data, base):
+        """Counts lines started in data and indexes those that begin a block, base is offset of data"""
+        count = data.count(b"\n")
+        # Newlines up to the start of the next indexed line
+        needed = len(self._offsets) * Scrollback.INDEX_STEP - self._lines + 1
+        if needed <= count:
+            end = Scrollback._lines_pattern(needed).match(data).end()
+            self._offsets.append(base + end)
+            # Matching stops before incomplete block, trying it at each position would be quadratic
+            blocks = (count - needed) // Scrollback.INDEX_STEP
+            matches = Scrollback._lines_pattern(Scrollback.INDEX_STEP).finditer(data, end)
+            self._offsets.extend(base + match.end() for match in islice(matches, blocks))
+        self._lines += count
+
+    @property
+    def line_count(self):
+        """Number of lines, including last line that isn't finished yet"""
+        return self._lines
+
+    def append(self, text):
+        data = text.encode("utf-8")
+        with self._lock:
+            self._file.write(data)
+            self._index(data, self._size)
+            self._size += len(data)
+
+    def _map(self):
+        """Returns memory map covering whole content, it is recreated only when content grows"""
+        if self._mmap is None or len(self._mmap) < self._size:
+            self._file.flush()
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _offset(self, line):
+        if line >= self._lines:
+            return self._size
+        block, skip = divmod(line, Scrollback.INDEX_STEP)
+        offset = self._offsets[block]
+        if skip:
+            data = self._map()
+            for _ in range(skip):
+                offset = data.find(b"\n", offset) + 1
+        return offset
+
+    def text(self, start, end=None):
+        """Returns lines from start up to (not including) end"""
+        with self._lock:
+            begin, finish = self._offset(start), self._offset(self.line_count if end is None else end)
+            if begin >= finish:
+                return ""
+            return self._map()[begin:finish].decode("utf-8", errors="replace")
+
+    def find(self, text, start=0):
+        """Returns first line from start which contains text or -1 if there is none"""
+        needle = text.encode("utf-8")
+        with self._lock:
+            if not needle or not self._size:
+                return -1
+            idx = self._map().find(needle, self._offset(start))
+            if idx < 0:
+                return -1
+            block = bisect_right(self._offsets, idx) - 1
+            return block * Scrollback.INDEX_STEP + self._map()[self._offsets[block]:idx].count(b"\n")
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            self._file.close()
@@ -1,19 +1,36 @@
 import base64
 import os
 import re
+import select
 import time
-from threading import Thread
+import zlib
 
 import serial
 from src.utility.settings import Settings
 
 from src.connection.connection import Connection
 from src.helpers.pyinstaller_helper import PyInstallerHelper
-from src.logic.file_transfer import FileTransfer, FileTransferError
+from src.helpers.raw_transfer_helper import RawTransferHelper
+from src.logic.file_transfer import FileTransfer, FileTransferError, FileSource, JoinedData
 from src.utility.exceptions import OperationError
 
 
 class SerialConnection(Connection):
+    # Header of transfer scripts, changes whenever their protocol changes
+    TRANSFER_SCRIPTS_VERSION = "#V7"
+    # Chunk numbers wrap at 100 and receiver has to tell new chunks from
+    # repeated ones, so at most half of them can be in flight
+    MAX_TRANSFER_WINDOW = 49
+    # Time to wait for response before chunk is sent again
+    TRANSFER_RESEND_TIMEOUT = 0.5
+    # Number of consecutive failed attempts after which transfer is aborted
+    TRANSFER_MAX_RETRIES = 10
+    # Longest time single read blocks, reads return as soon as requested data arrive
+    READ_TIMEOUT = 0.05
+    # Longest time idle wait for terminal output blocks, it is interrupted by new command anyway.
+    # Only used where port can be selected, elsewhere READ_TIMEOUT bounds the wait.
+    IDLE_READ_TIMEOUT = 0.5
+
     def __init__(self, port, baud_rate, terminal=None, reset=False):
         Connection.__init__(self, terminal)
 
@@ -21,7 +38,8 @@ class SerialConnection(Connection):
         self._baud_rate = baud_rate
 
         try:
-            self._serial = serial.Serial(None, self._baud_rate, timeout=0, write_timeout=0.2)
+            self._serial = serial.Serial(None, self._baud_rate, timeout=SerialConnection.READ_TIMEOUT,
+                                         write_timeout=0.2)
             self._serial.dtr = False
             self._serial.rts = False
             self._serial.port = port
@@ -40,17 +58,14 @@ class SerialConnection(Connection):
         except Exception as e:
             return
 
-        self._reader_thread = Thread(target=self._reader_thread_routine)
-        self._reader_thread.start()
+        self._start_io_thread()
 
     def is_connected(self):
         return self._serial is not None
 
     def disconnect(self):
         if self.is_connected():
-            if self._reader_thread.is_alive():
-                self._reader_running = False
-                self._reader_thread.join()
+            self._stop_io_thread()
             self._serial.close()
             self._serial = None
 
@@ -61,7 +76,7 @@ class SerialConnection(Connection):
         self._serial.write((line_text + ending).encode('utf-8'))
         time.sleep(Settings().send_sleep)
 
-    def send_character(self, char):
+    def _send_character(self, char):
         assert isinstance(char, str)
 
         self._serial.write(char.encode('utf-8'))
@@ -71,73 +86,74 @@ class SerialConnection(Connection):
         self._serial.write(binary)
         time.sleep(Settings().send_sleep)
 
-    def read_line(self):
-        x = self._serial.readline()
-
-        if x and self._terminal is not None:
-            if x == b'\x08\x1b[K':
-                x = b'\x08'
-
-            self._terminal.add(x.decode("utf-8", errors="replace"))
+    def send_raw(self, binary):
+        self._serial.write(binary)
 
+    def read_line(self):
+        x = self._take_unread()
+        if not x:
+            # Port keeps short timeout of protocol reads, idle wait is done by select on POSIX,
+            # together with pipe that pyserial's cancel_read writes to
+            abort = getattr(self._serial, "pipe_abort_read_r", None)
+            if abort is not None:
+                readable, _, _ = select.select([self._serial.fd, abort], [], [], SerialConnection.IDLE_READ_TIMEOUT)
+                if abort in readable:
+                    os.read(abort, 1000)
+                x = self._serial.read(self._serial.in_waiting) if self._serial.fd in readable else b""
+            else:
+                x = self._serial.read(1)
+                if x:
+                    # Rest of output that arrived with first byte
+                    x += self._serial.read(self._serial.in_waiting)
+        self._to_terminal(x)
         return x
 
+    def _wake_io_thread(self):
+        # Ends blocking read, I/O thread then picks up the new command.
+        # Port may be closed by another thread in the meantime.
+        port = self._serial
+        if port is not None:
+            port.cancel_read()
+
     def _break_device_read(self):
-        time.sleep(1)
+        self._unread = b""
         self.send_kill()
+        # Scripts run in raw REPL, leave it
+        self.send_raw(b"\x02")
+        # Wait only until device is back in REPL
+        try:
+            self.read_to_next_prompt(1.0)
+        except TimeoutError:
+            pass
 
     def read_with_timeout(self, count, timeout_s=2.0):
-        period = 0.005
-        data = bytearray()
-        for i in range(0, int(timeout_s / period)):
-            rec = self._serial.read(count - len(data))
-            if rec:
-                data.extend(rec)
-                if len(data) == count:
-                    return bytes(data)
-            time.sleep(period)
-
-        return None
+        data = bytearray(self._unread[:count])
+        self._unread = self._unread[count:]
+        t_start = time.time()
+        # Each read waits for data in the driver, there is no need to poll
+        while len(data) < count:
+            if time.time() - t_start >= timeout_s:
+                return None
+            data.extend(self._serial.read(count - len(data)))
+        return bytes(data)
 
     def read_all(self):
-        buffer = ""
+        buffer = bytearray(self._take_unread())
         while True:
-            x = self._serial.read(100)
+            # Read only what has already arrived, without waiting for more
+            x = self._serial.read(self._serial.in_waiting)
             if x is None or not x:
                 break
-            buffer += x.decode('utf-8', errors="replace")
-
-        if self._terminal is not None:
-            self._terminal.add(buffer)
+            buffer.extend(x)
 
-        return buffer
+        return self._to_terminal(bytes(buffer))
 
     def read_junk(self):
         self.read_all()
 
-    def read_one_byte(self):
-        return self._serial.read(1)
-
-    def list_files(self):
-        success = True
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
-        self.send_kill()
-        self.read_junk()
-        self.send_line("import os; os.listdir()")
-        self._serial.flush()
-        ret = ""
-        try:
-            ret = self.read_to_next_prompt()
-        except TimeoutError:
-            success = False
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
-
-        if success and ret:
-            return re.findall("'([^']+)'", ret)
-        else:
-            raise OperationError()
+    def _read_available(self):
+        # Waits for at least one byte, but takes everything that is buffered
+        return self._serial.read(max(1, self._serial.in_waiting))
 
     @staticmethod
     def escape_characters(text):
@@ -151,30 +167,22 @@ class SerialConnection(Connection):
                 ret += c
         return ret
 
+    _VERSION_CODE = "\n".join([
+        "for n in (\"__upload.py\", \"__download.py\"):",
+        "  with open(n) as f:",
+        "    print(f.readline().strip())",
+        ""])
+
     def check_transfer_scripts_version(self):
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
-        self.send_kill()
-        self.read_junk()
-        self.send_block("with open(\"__upload.py\") as f:\n  f.readline()\n")
-        self._serial.flush()
-        success = True
+        return self._call(self._check_transfer_scripts_version)
+
+    def _check_transfer_scripts_version(self):
         try:
-            resp = self.read_to_next_prompt()
-            idx = resp.find("#V")
-            if idx < 0 or resp[idx:idx+3] != "#V2":
-                raise ValueError
-            self.read_junk()
-            self.send_block("with open(\"__download.py\") as f:\n  f.readline()\n")
-            self._serial.flush()
-            resp = self.read_to_next_prompt()
-            idx = resp.find("#V")
-            if idx < 0 or resp[idx:idx+3] != "#V2":
-                raise ValueError
-        except (TimeoutError, ValueError):
+            out, err = self.execute(SerialConnection._VERSION_CODE)
+            versions = re.findall(r"#V\d+", out)
+            success = not err and versions == [SerialConnection.TRANSFER_SCRIPTS_VERSION] * 2
+        except (TimeoutError, OperationError):
             success = False
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
         return success
 
     @staticmethod
@@ -190,154 +198,393 @@ class SerialConnection(Connection):
 
         return PyInstallerHelper.resource_path("mcu/" + transfer_file_name)
 
-    def send_upload_file(self, file_name):
-        with open(SerialConnection._transfer_file_path("upload.py")) as f:
-            data = f.read()
-            data = data.replace("file_name.py", file_name)
-            self.send_start_paste()
-            lines = data.split("\n")
-            for line in lines:
-                self.send_line(line, "\r")
-            self.send_end_paste()
-
-    def send_download_file(self, file_name):
-        with open(SerialConnection._transfer_file_path("download.py")) as f:
-            data = f.read()
-            data = data.replace("file_name.py", file_name)
-            self.send_start_paste()
-            lines = data.split("\n")
-            for line in lines:
-                self.send_line(line, "\r")
-            self.send_end_paste()
+    @staticmethod
+    def _transfer_script_globals(file_name, resume_offset=0, batch=False):
+        return "file_name={}; raw_transfer={}; resume_offset={}; batch={}".format(
+            repr(file_name), Settings().raw_transfer, resume_offset, batch)
+
+    def _start_transfer_script(self, transfer_file_name, script_globals, saved=None):
+        """Starts transfer script in raw REPL, either the one saved on device or whole sent from PC.
+
+        Raises FileNotFoundError if script is missing on PC and TimeoutError or
+        OperationError if it couldn't be started.
+        """
+        if saved is None:
+            saved = Settings().use_transfer_scripts
+        if saved:
+            code = "\n".join([script_globals,
+                              "with open(\"__{}\") as f:".format(transfer_file_name),
+                              "    exec(f.read(), globals())"])
+        else:
+            with open(SerialConnection._transfer_file_path(transfer_file_name)) as f:
+                code = script_globals + "\n" + f.read().replace("\"file_name.py\"", "file_name")
+        self._raw_exec_start(code)
+
+    def _end_transfer_script(self):
+        """Waits until finished transfer script ends and leaves raw REPL"""
+        try:
+            self._raw_exec_output(1.0)
+        except TimeoutError:
+            pass
+        self._exit_raw_repl()
 
     def _upload_transfer_files_job(self, transfer):
         assert isinstance(transfer, FileTransfer)
         transfer.set_file_count(2)
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
         try:
-            self.send_upload_file("__upload.py")
-            self.read_all()
+            self._start_transfer_script("upload.py", self._transfer_script_globals("__upload.py"), False)
             with open(SerialConnection._transfer_file_path("upload.py")) as f:
                 data = f.read()
-                data = data.replace("\"file_name.py\"", "file_name")
-                self.send_file(data.encode('utf-8'), transfer)
+                data = data.replace("\"file_name.py\"", "file_name").encode('utf-8')
+                self.send_file(data, transfer)
+            self._end_transfer_script()
+            self._cache_file_written("__upload.py", len(data))
             transfer.mark_finished()
 
-            self.run_file("__upload.py", "file_name=\"{}\"".format("__download.py"))
-            self.read_all()
+            self._start_transfer_script("upload.py", self._transfer_script_globals("__download.py"), True)
             with open(SerialConnection._transfer_file_path("download.py")) as f:
                 data = f.read()
-                data = data.replace("\"file_name.py\"", "file_name")
-                self.send_file(data.encode('utf-8'), transfer)
+                data = data.replace("\"file_name.py\"", "file_name").encode('utf-8')
+                self.send_file(data, transfer)
+            self._end_transfer_script()
+            self._cache_file_written("__download.py", len(data))
             transfer.mark_finished()
+        except (TimeoutError, OperationError):
+            self._break_device_read()
+            transfer.mark_error()
         except (FileNotFoundError, FileTransferError):
             transfer.mark_error()
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
 
     def upload_transfer_files(self, transfer):
-        job_thread = Thread(target=self._upload_transfer_files_job, args=[transfer])
-        job_thread.setDaemon(True)
-        job_thread.start()
+        return self._submit_transfer(transfer, self._upload_transfer_files_job, transfer)
+
+    @staticmethod
+    def _encode_chunk(chunk):
+        if Settings().raw_transfer:
+            return RawTransferHelper.escape(chunk)
+        return base64.b64encode(chunk)
+
+    @staticmethod
+    def _decode_chunk(chunk):
+        if Settings().raw_transfer:
+            return RawTransferHelper.unescape(chunk)
+        return base64.b64decode(chunk)
+
+    def _send_chunk(self, seq, chunk):
+        # Encode data to prevent special REPL sequences
+        en_chunk = self._encode_chunk(chunk)
+        seq %= 100
+        # Checksum includes chunk number, so that chunk can't end up in wrong place
+        self._serial.write(b"".join([b"#", "{:02d}{:02d}{:08x}".format(
+            seq, len(en_chunk), zlib.crc32(chunk, seq) & 0xffffffff).encode("ascii"), en_chunk]))
+
+    def _read_marked(self, count):
+        """Skips data until frame mark and reads count bytes that follow it.
+
+        Returns None if nothing was received or if the data contain another mark,
+        which means that they were corrupted.
+        """
+        mark = self.read_with_timeout(1, SerialConnection.TRANSFER_RESEND_TIMEOUT)
+        while mark is not None and mark != b"#":
+            mark = self.read_with_timeout(1, SerialConnection.TRANSFER_RESEND_TIMEOUT)
+        if mark is None:
+            return None
+        data = self.read_with_timeout(count, SerialConnection.TRANSFER_RESEND_TIMEOUT)
+        if data is not None and b"#" in data:
+            # Keep the next mark, it's start of next frame
+            self._unread = data[data.index(b"#"):] + self._unread
+            return None
+        return data
+
+    def _read_frame(self):
+        """Reads frame sent by download script.
+
+        Returns tuple of chunk number and decoded chunk (None if chunk is corrupted)
+        or None if frame wasn't received at all.
+        """
+        header = self._read_marked(12)
+        if header is None:
+            return None
+        try:
+            seq, count, crc = int(header[0:2]), int(header[2:4]), int(header[4:12], 16)
+        except ValueError:
+            return None
+        data = self.read_with_timeout(count, SerialConnection.TRANSFER_RESEND_TIMEOUT) if count else b""
+        if data is None:
+            return seq, None
+        if b"#" in data:
+            # Mark of next frame, this one is incomplete
+            self._unread = data[data.index(b"#"):] + self._unread
+            return seq, None
+        try:
+            chunk = self._decode_chunk(data)
+        except ValueError:
+            return seq, None
+        return seq, chunk if zlib.crc32(chunk, seq) & 0xffffffff == crc else None
+
+    def _read_reply(self):
+        """Reads reply of upload script.
+
+        Returns tuple of code and chunk number or None if no valid reply came.
+        """
+        reply = self._read_marked(5)
+        if reply is None:
+            return None
+        try:
+            if zlib.crc32(reply[:3]) & 0xff != int(reply[3:5], 16):
+                return None
+            return reply[:1], int(reply[1:3])
+        except ValueError:
+            return None
+
+    def _read_resume_offset(self):
+        """Reads offset from which upload script continues writing interrupted upload"""
+        # Skip anything that isn't offset reply
+        t_start = time.time()
+        while time.time() - t_start < 2.0:
+            reply = self._read_marked(11)
+            if reply is not None and reply[:1] == b"O":
+                try:
+                    if zlib.crc32(reply[:9]) & 0xff == int(reply[9:11], 16):
+                        return int(reply[1:9], 16)
+                except ValueError:
+                    pass
+        self._break_device_read()
+        raise FileTransferError()
 
-    def send_file(self, data, transfer):
+    def _send_response(self, code, seq):
+        """Sends response to download script, either ACK or NAK"""
+        response = "{}{:02d}".format(code, seq).encode("ascii")
+        # Short checksum protects response against corruption too
+        self._serial.write(b"".join([b"#", response, "{:02x}".format(zlib.crc32(response) & 0xff).encode("ascii")]))
+
+    def send_file(self, data, transfer, offset=0, confirmed_callback=None):
+        """Sends data to upload script, starting at offset.
+
+        Progress is reported to transfer, unless confirmed_callback is given, which
+        is then called with number of bytes confirmed by device instead.
+        """
         assert isinstance(transfer, FileTransfer)
-        # Split data into smaller chunks
-        idx = 0
-        # Using chunks of 48 bytes, encoded chunk should be at most 64 bytes
+        # Using chunks of 48 bytes, encoded chunk should be at most 64 bytes (96 bytes if escaped)
         n = 48
         total_len = len(data)
-        while idx < total_len:
-            chunk = data[idx:idx + n]
-            # Encode data to prevent special REPL sequences
-            en_chunk = base64.b64encode(chunk)
-            self._serial.write(b"".join([b"#", str(len(en_chunk)).zfill(2).encode("ascii"), en_chunk]))
-            ack = self.read_with_timeout(2)
-            if not ack or ack != b"#1":
-                # Make sure that the device isn't stuck in read
+        chunk_count = (total_len - offset + n - 1) // n
+        transfer.confirmed_bytes = offset
+        # Number of chunks that can be sent without waiting for ACK
+        window = min(max(Settings().transfer_window_size, 1), SerialConnection.MAX_TRANSFER_WINDOW)
+        sent = 0
+        acked = 0
+        # Number of times each chunk was sent again
+        retries = {}
+        # Time of last valid reply, garbage (e.g. rest of script echo) doesn't mean that anything was lost
+        last_reply = time.time()
+
+        def resend(idx):
+            retries[idx] = retries.get(idx, 0) + 1
+            if retries[idx] > SerialConnection.TRANSFER_MAX_RETRIES:
+                self._break_device_read()
+                raise FileTransferError()
+            self._send_chunk(idx, data[offset + idx * n:offset + (idx + 1) * n])
+
+        while acked < chunk_count:
+            # Keep the window full
+            while sent < chunk_count and sent - acked < window:
+                self._send_chunk(sent, data[offset + sent * n:offset + (sent + 1) * n])
+                sent += 1
+
+            reply = self._read_reply()
+            if reply is None:
+                if time.time() - last_reply < SerialConnection.TRANSFER_RESEND_TIMEOUT:
+                    continue
+                # Either chunk or reply was lost, send oldest chunk again. If there are
+                # any other chunks missing, device will request them once it gets this one.
+                resend(acked)
+                last_reply = time.time()
+                continue
+
+            last_reply = time.time()
+            code, seq = reply
+            # Chunk numbers are sent modulo 100, find which chunk in the window it is
+            idx = acked + (seq - acked) % 100
+            if code == b"1" and acked < idx <= sent:
+                # ACKs are cumulative, device reports number of next chunk it expects
+                for x in range(acked, idx):
+                    retries.pop(x, None)
+                acked = idx
+                transfer.confirmed_bytes = min(offset + acked * n, total_len)
+                if confirmed_callback:
+                    confirmed_callback(transfer.confirmed_bytes)
+                else:
+                    transfer.progress = transfer.confirmed_bytes / total_len
+            elif code == b"5" and idx < sent:
+                # Device received corrupted chunk or detected that it's missing
+                resend(idx)
+            elif code == b"4":
                 self._break_device_read()
                 raise FileTransferError()
-            idx += len(chunk)
-            transfer.progress = idx / total_len
 
         # Mark end and check for success
-        self._serial.write(b"#00")
-        check = self.read_with_timeout(2)
+        for _ in range(SerialConnection.TRANSFER_MAX_RETRIES):
+            self._send_chunk(chunk_count, b"")
+            reply = self._read_reply()
+            if reply is not None and reply[0] == b"0":
+                return
+            if reply is not None and reply[0] == b"4":
+                break
 
-        if check != b"#0":
-            # Make sure that the device isn't stuck in read
-            self._break_device_read()
-            raise FileTransferError()
+        self._break_device_read()
+        raise FileTransferError()
 
-    def recv_file(self, transfer):
+    def recv_file(self, transfer, sink):
+        """Receives data from download script and writes them to sink"""
         assert isinstance(transfer, FileTransfer)
-        result = b""
+        expected = 0
+        retries = 0
 
         # Initiate transfer
         self._serial.write(b"###")
-        while True:
-            data = self.read_with_timeout(3)
-            if not data or data[0] != ord("#"):
-                self._serial.write(b"#2")
-                break
-            count = int(data[1:3])
-            if count == 0:
-                transfer.read_result.binary_data = result
-                return
-            data = self.read_with_timeout(count)
-            if data:
-                result += base64.b64decode(data)
-                # Send ACK
-                self._serial.write(b"#1")
+        while retries <= SerialConnection.TRANSFER_MAX_RETRIES:
+            frame = self._read_frame()
+            if frame is not None and frame[1] is not None and frame[0] == expected:
+                retries = 0
+                expected = (expected + 1) % 100
+                # Send ACK, requesting next chunk
+                self._send_response(1, expected)
+                if not frame[1]:
+                    # Empty chunk marks end of file
+                    return
+                sink.write(frame[1])
+            elif frame is not None and frame[1] is not None and frame[0] == (expected - 1) % 100:
+                # Repeated chunk, ACK was lost
+                self._send_response(1, expected)
             else:
-                self._serial.write(b"#3")
-                break
+                # Send NAK, requesting chunk again
+                retries += 1
+                self._send_response(5, expected)
 
         # Make sure that the device isn't stuck in read
         self._break_device_read()
-        transfer.read_result.binary_data = None
         raise FileTransferError()
 
     def _write_file_job(self, file_name, text, transfer):
         if isinstance(text, str):
             text = text.encode('utf-8')
 
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
-        if Settings().use_transfer_scripts:
-            self.run_file("__upload.py", "file_name=\"{}\"".format(file_name))
-        else:
-            try:
-                self.send_upload_file(file_name)
-            except FileNotFoundError:
-                transfer.mark_error()
-        if not transfer.error:
-            self.read_junk()
-            try:
-                self.send_file(text, transfer)
-                transfer.mark_finished()
-            except FileTransferError:
-                transfer.mark_error()
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
-
-    def _read_file_job(self, file_name, transfer):
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
-        if Settings().use_transfer_scripts:
-            self.run_file("__download.py", "file_name=\"{}\"".format(file_name))
-        else:
-            try:
-                self.send_download_file(file_name)
-            except FileNotFoundError:
-                transfer.mark_error()
-        if not transfer.error:
-            self.read_junk()
-            try:
-                self.recv_file(transfer)
+        size = len(text)
+        remote_name, text, compressed = self._compress_for_upload(file_name, text)
+        # Chunks are sliced from view to avoid copying
+        text = memoryview(text)
+        resume_offset = self._resume_offset(remote_name, text)
+        transfer.confirmed_bytes = 0
+        try:
+            self._start_transfer_script("upload.py", self._transfer_script_globals(remote_name, resume_offset))
+            offset = self._read_resume_offset() if resume_offset else 0
+            if offset > len(text):
+                # Temporary file doesn't belong to this content
+                self._forget_partial_upload(remote_name)
+                self._break_device_read()
+                raise FileTransferError()
+            self.send_file(text, transfer, offset)
+            self._end_transfer_script()
+            self._forget_partial_upload(remote_name)
+            if compressed and not self._decompress_uploaded(file_name, size):
+                # Compressed content arrived whole, so there is nothing to resume
+                transfer.mark_error("Decompression on device failed.")
+                return
+            self._cache_file_written(file_name, size)
+            transfer.mark_finished()
+        except (TimeoutError, OperationError):
+            self._break_device_read()
+            transfer.mark_error()
+        except FileNotFoundError:
+            transfer.mark_error()
+        except FileTransferError:
+            if transfer.confirmed_bytes:
+                self._record_partial_upload(remote_name, text, transfer.confirmed_bytes)
+            transfer.mark_error()
+        except serial.SerialException:
+            # Cable was unplugged or write timed out, data confirmed so far stay on device
+            if transfer.confirmed_bytes:
+                self._record_partial_upload(remote_name, text, transfer.confirmed_bytes)
+            transfer.mark_error("Connection to device failed.")
+
+    def _write_files_job(self, local_file_paths, remote_names, transfer):
+        # Compressed and resumed uploads need separate script run for each file
+        if len(local_file_paths) < 2 or Settings().compress_transfer or \
+                any(name in Connection._partial_uploads for name in remote_names):
+            Connection._write_files_job(self, local_file_paths, remote_names, transfer)
+            return
+        if not self._make_remote_dirs(remote_names, transfer):
+            return
+
+        # All files are sent in single stream of records, each is header with size and name followed by content
+        sources = []
+        records = []
+        names = []
+        ends = []
+        total_len = 0
+        try:
+            for local_path, remote_name in zip(local_file_paths, remote_names):
+                source = FileSource(local_path)
+                sources.append(source)
+                names.append(remote_name)
+                header = "{} {}\n".format(len(source.data), names[-1]).encode("utf-8")
+                records += [header, source.data]
+                total_len += len(header) + len(source.data)
+                ends.append(total_len)
+        except IOError:
+            for source in sources:
+                source.close()
+            transfer.mark_error("Couldn't read local file.")
+            return
+
+        def confirmed(count):
+            # Device writes each file under its name once all of its data arrive
+            while transfer.file_index < len(ends) - 1 and count >= ends[transfer.file_index]:
+                self._cache_file_written(names[transfer.file_index], len(sources[transfer.file_index].data))
                 transfer.mark_finished()
-            except FileTransferError:
+                if transfer.cancel_scheduled:
+                    self._break_device_read()
+                    raise FileTransferError()
+            idx = transfer.file_index
+            start = ends[idx - 1] if idx else 0
+            transfer.progress = (count - start) / (ends[idx] - start)
+
+        try:
+            self._start_transfer_script("upload.py", self._transfer_script_globals("", batch=True))
+            self.send_file(JoinedData(records), transfer, confirmed_callback=confirmed)
+            self._end_transfer_script()
+            self._cache_file_written(names[-1], len(sources[-1].data))
+            transfer.mark_finished()
+        except (TimeoutError, OperationError):
+            self._break_device_read()
+            transfer.mark_error()
+        except FileNotFoundError:
+            transfer.mark_error()
+        except FileTransferError:
+            if transfer.cancel_scheduled:
+                transfer.confirm_cancel()
+            else:
                 transfer.mark_error()
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
+        finally:
+            # Also on errors that propagate out of the job (e.g. unplugged port)
+            records = None
+            for source in sources:
+                source.close()
+
+    def _read_file_job(self, file_name, transfer, sink):
+        success = True
+        try:
+            self._start_transfer_script("download.py", self._transfer_script_globals(file_name))
+            self.recv_file(transfer, sink)
+            self._end_transfer_script()
+        except (TimeoutError, OperationError):
+            self._break_device_read()
+            success = False
+        except (FileNotFoundError, FileTransferError):
+            success = False
+        except OSError:
+            # Local file couldn't be written (e.g. disk is full), device is still sending
+            self._break_device_read()
+            success = False
+        self._finish_read(transfer, sink, success)
@@ -1,24 +1,103 @@
+from collections import deque
+from threading import Lock
+
+from src.connection.scrollback import Scrollback
+from src.utility.settings import Settings
 from src.utility.signal_interface import Event
 
 
 class Terminal:
-    def __init__(self):
+    # Small outputs are merged into chunks of about this size, so that chunk count stays low
+    CHUNK_SIZE = 4096
+
+    def __init__(self, max_size=None, scrollback=None):
         self.add_event = Event()
-        self.buffer = ""
-        self.history = ""
+        # Complete output is kept on disk, lines before first_line were cleared
+        # Reason why configured log file couldn't be used, output is then kept in temporary file
+        self.log_file_error = None
+        self.scrollback = scrollback or self._open_scrollback(Settings().terminal_log_file)
+        self.first_line = 0
+        # Oldest output is dropped once the total size exceeds this number of characters
+        self.max_size = max_size or Settings().terminal_history_size
+        self._chunks = deque()
+        self._size = 0
+        # Number of newest characters that weren't read yet
+        self._unread = 0
+        self._lock = Lock()
         self.input_history = []
 
+    def _open_scrollback(self, path):
+        try:
+            return Scrollback(path)
+        except OSError as e:
+            self.log_file_error = "Couldn't open terminal log file {}: {}".format(path, e.strerror or e)
+            return Scrollback()
+
     def add(self, string):
-        self.buffer += string
+        if not string:
+            return
+        with self._lock:
+            if self._chunks and len(self._chunks[-1]) < Terminal.CHUNK_SIZE:
+                self._chunks[-1] += string
+            else:
+                self._chunks.append(string)
+            self._size += len(string)
+            self._unread += len(string)
+            self.scrollback.append(string)
+            self._trim()
         self.add_event.signal()
 
+    def _trim(self):
+        while self._size > self.max_size:
+            overflow = self._size - self.max_size
+            if len(self._chunks[0]) > overflow:
+                self._chunks[0] = self._chunks[0][overflow:]
+                self._size -= overflow
+                break
+            self._size -= len(self._chunks.popleft())
+        self._unread = min(self._unread, self._size)
+
+    def _tail(self, count):
+        parts = []
+        for chunk in reversed(self._chunks):
+            if count <= 0:
+                break
+            parts.append(chunk[-count:])
+            count -= len(chunk)
+        return "".join(reversed(parts))
+
+    @property
+    def buffer(self):
+        """Output which wasn't read yet"""
+        with self._lock:
+            return self._tail(self._unread)
+
+    @property
+    def history(self):
+        """Output which was already read, at most max_size characters"""
+        with self._lock:
+            text = "".join(self._chunks)
+            return text[:len(text) - self._unread]
+
+    def read_tail(self, line_count):
+        """Marks output as read and returns index of first returned line and last lines of output"""
+        with self._lock:
+            self._unread = 0
+            first = max(self.first_line, self.scrollback.line_count - line_count)
+            return first, self.scrollback.text(first)
+
     def read(self):
-        self.history += self.buffer
-        ret, self.buffer = self.buffer, ""
+        with self._lock:
+            ret = self._tail(self._unread)
+            self._unread = 0
         return ret
 
     def clear(self):
-        self.history = self.buffer = ""
+        with self._lock:
+            self._chunks.clear()
+            self._size = 0
+            self._unread = 0
+            self.first_line = self.scrollback.line_count - 1
 
     def add_input(self, input_string):
         self.input_history.append(input_string)
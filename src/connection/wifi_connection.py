@@ -1,7 +1,7 @@
 import re
+import select
 import socket
 import struct
-from threading import Thread
 import traceback
 
 import time
@@ -18,6 +18,34 @@ class WifiConnection(Connection):
     WEBREPL_PUT_FILE = 1
     WEBREPL_GET_FILE = 2
     WEBREPL_GET_VER = 3
+    # Uploads at least this large go to temporary file first, so that they can be resumed
+    RESUMABLE_MIN_SIZE = 16 * 1024
+
+    _PART_SIZE_CODE = "\n".join([
+        "import os",
+        "try:",
+        "  print(\"#S\", os.stat({part})[6])",
+        "except OSError:",
+        "  print(\"#S\", 0)",
+        ""])
+
+    _FINISH_PART_CODE = "\n".join([
+        "import os",
+        "if {append}:",
+        "  with open({part}, \"ab\") as o, open({tail}, \"rb\") as i:",
+        "    while True:",
+        "      b = i.read(256)",
+        "      if not b:",
+        "        break",
+        "      x = o.write(b)",
+        "  os.remove({tail})",
+        "try:",
+        "  os.remove({name})",
+        "except OSError:",
+        "  pass",
+        "os.rename({part}, {name})",
+        "print(\"#R\", \"ok\")",
+        ""])
 
     def __init__(self, host, port, terminal, password_prompt):
         Connection.__init__(self, terminal)
@@ -25,6 +53,9 @@ class WifiConnection(Connection):
         self._port = port
         self.s = None
         self.ws = None
+        # Writing to this pair wakes I/O thread waiting for data from device
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_w.setblocking(False)
 
         if not self._start_connection():
             return
@@ -33,8 +64,7 @@ class WifiConnection(Connection):
             self._clear()
             raise PasswordException()
 
-        self._reader_thread = Thread(target=self._reader_thread_routine)
-        self._reader_thread.start()
+        self._start_io_thread()
 
     def _start_connection(self):
         self.s = socket.socket()
@@ -98,73 +128,62 @@ class WifiConnection(Connection):
 
     def disconnect(self):
         if self.is_connected():
-            if self._reader_thread.is_alive():
-                self._reader_running = False
-                self._reader_thread.join()
+            self._stop_io_thread()
             self.s.close()
             self.s = None
+        self._wake_r.close()
+        self._wake_w.close()
 
     def read_all(self):
-        x = self.ws.read_all().decode("utf-8", errors="replace")
+        return self._to_terminal(self._take_unread() + self.ws.read_all())
 
-        if x and self._terminal is not None:
-            self._terminal.add(x)
-
-        return x
-
-    # TODO: Join with serial implementation? At least the special character handling
     def read_line(self):
-        x = self.ws.read_all(0.2)
-
-        if x and self._terminal is not None:
-            if x == b'\x08\x1b[K':
-                x = b'\x08'
-            if x[:3] == b'\x1b[':  # Control sequence
-                # TODO: regex firt match 14D on x[3:]
-                pass
-
-            self._terminal.add(x.decode("utf-8", errors="replace"))
-
+        x = self._take_unread()
+        if not x:
+            if not self.ws.buf:
+                # Waits for device or for new command, whichever comes first
+                readable, _, _ = select.select([self.s, self._wake_r], [], [], 0.2)
+                if self._wake_r in readable:
+                    self._wake_r.recv(4096)
+            x = self.ws.read_all(0)
+
+        # Control sequences are handled by terminal view
+        self._to_terminal(x)
         return x
 
     def read_junk(self):
+        self._unread = b""
         self.ws.read_all(0)
 
-    def read_one_byte(self):
-        return self.ws.read(1)
+    def _read_available(self):
+        # Rest of frame that was partially read by sized read comes first
+        if self.ws.buf:
+            x, self.ws.buf = self.ws.buf, b""
+            return x
+        return self.ws.read_all(0.05)
+
+    def _wake_io_thread(self):
+        try:
+            self._wake_w.send(b"\x00")
+        except BlockingIOError:
+            # Thread has plenty of wake-ups pending already
+            pass
 
-    def send_character(self, char):
+    def _send_character(self, char):
         assert isinstance(char, str)
         self.ws.write(char)
 
     def send_bytes(self, binary):
         self.ws.write(binary)
 
+    def send_raw(self, binary):
+        self.ws.write(binary)
+
     def send_line(self, line_text, ending="\r\n"):
         assert isinstance(line_text, str)
         assert isinstance(ending, str)
         self.ws.write(line_text + ending)
 
-    #TODO: Could be merged with serial connection?
-    def list_files(self):
-        success = True
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
-        self.send_kill()
-        self.read_junk()
-        self.ws.write("import os;os.listdir()\r\n")
-        ret = ""
-        try:
-            ret = self.read_to_next_prompt()
-        except TimeoutError:
-            success = False
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
-        if success and ret:
-            return re.findall("'([^']+)'", ret)
-        else:
-            raise OperationError()
-
     @staticmethod
     def read_resp(ws):
         data = ws.read(4)
@@ -173,92 +192,134 @@ class WifiConnection(Connection):
         return code
 
     # TODO: Edit protocol to send total length so progress can be set correctly
-    def _read_file_job(self, file_name, transfer):
+    def _read_file_job(self, file_name, transfer, sink):
         assert isinstance(transfer, FileTransfer)
         if isinstance(file_name, str):
             file_name = file_name.encode("utf-8")
 
-        ret = b""
         rec = struct.pack(WifiConnection.WEBREPL_REQ_S, b"WA", WifiConnection.WEBREPL_GET_FILE, 0, 0, 0, len(file_name),
                           file_name)
 
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
         self.read_junk()
 
-        self.ws.write(rec, True)
-        assert self.read_resp(self.ws) == 0
-
-        while True:
-            # Confirm message
-            self.ws.write(b"\1", True)
-            (sz,) = struct.unpack("<H", self.ws.read(2))
-            if sz == 0:
-                break
-            while sz:
-                buf = self.ws.read(sz)
-                if not buf:
-                    raise OSError()
-                ret += buf
-                sz -= len(buf)
-
-        if self.read_resp(self.ws) == 0:
-            transfer.mark_finished()
-            transfer.read_result.binary_data = ret
-        else:
-            transfer.mark_error()
-            transfer.read_result.binary_data = None
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
+        success = False
+        try:
+            self.ws.write(rec, True)
+            if self.read_resp(self.ws) != 0:
+                # File doesn't exist or can't be read
+                raise OSError()
 
-    def _write_file_job(self, file_name, text, transfer):
-        def mark_error_and_release():
-            transfer.mark_error()
-            self._auto_read_enabled = True
-            self._auto_reader_lock.release()
+            while True:
+                # Confirm message
+                self.ws.write(b"\1", True)
+                (sz,) = struct.unpack("<H", self.ws.read(2))
+                if sz == 0:
+                    break
+                while sz:
+                    buf = self.ws.read(sz)
+                    if not buf:
+                        raise OSError()
+                    sink.write(buf)
+                    sz -= len(buf)
+
+            success = self.read_resp(self.ws) == 0
+        except (OSError, TimeoutError, AssertionError, struct.error):
+            # Response with wrong signature or cut short is treated same as failure
+            pass
+        self._finish_read(transfer, sink, success)
+
+    def _part_size(self, part_name):
+        """Returns size of temporary file left by interrupted upload, 0 if there is none"""
+        try:
+            resp, _ = self.execute(WifiConnection._PART_SIZE_CODE.format(part=repr(part_name)))
+        except (TimeoutError, OperationError):
+            return 0
+        match = re.search(r"#S (\d+)", resp)
+        return int(match.group(1)) if match else 0
+
+    def _finish_part(self, file_name, tail_size):
+        """Moves completed temporary file to its target name, tail of resumed upload is appended first"""
+        try:
+            resp, _ = self.execute(WifiConnection._FINISH_PART_CODE.format(
+                append=tail_size > 0, part=repr(file_name + ".part"), tail=repr(file_name + ".tail"),
+                name=repr(file_name)),
+                self._file_timeout(tail_size))
+        except (TimeoutError, OperationError):
+            return False
+        return re.search(r"#R ok", resp) is not None
 
-        assert isinstance(transfer, FileTransfer)
+    def _put_file(self, file_name, data, transfer, offset=0):
+        """Sends data to file on device, offset is amount of data that is already there"""
         if isinstance(file_name, str):
             file_name = file_name.encode("utf-8")
-        if isinstance(text, str):
-            text = text.encode("utf-8")
-
-        sz = len(text)
+        sz = len(data)
         rec = struct.pack(WifiConnection.WEBREPL_REQ_S, b"WA", WifiConnection.WEBREPL_PUT_FILE, 0, 0, sz,
                           len(file_name), file_name)
 
-        self._auto_reader_lock.acquire()
-        self._auto_read_enabled = False
         self.read_junk()
-
         self.ws.write(rec[:10], file_transfer=True)
         self.ws.write(rec[10:], file_transfer=True)
-        try:
-            if self.read_resp(self.ws) != 0:
-                mark_error_and_release()
-                return
-        except TimeoutError:
-            mark_error_and_release()
-            return
+        if self.read_resp(self.ws) != 0:
+            return False
 
         cnt = 0
+        total = offset + sz
         # Increase timeout from default value which gives
         # more time to MCU to process large files.
         original_timeout = self.ws.recv_timeout
         self.ws.recv_timeout = 30
         try:
             while True:
-                buf = text[cnt:cnt + 256]
+                buf = data[cnt:cnt + 256]
                 if not buf:
                     break
                 self.ws.write(buf, file_transfer=True)
                 cnt += len(buf)
-                transfer.progress = cnt / sz
+                transfer.confirmed_bytes = offset + cnt
+                transfer.progress = transfer.confirmed_bytes / total
 
-            if self.read_resp(self.ws) == 0:
-                transfer.mark_finished()
+            return self.read_resp(self.ws) == 0
+        finally:
+            self.ws.recv_timeout = original_timeout
+
+    def _write_file_job(self, file_name, text, transfer):
+        assert isinstance(transfer, FileTransfer)
+        if isinstance(text, str):
+            text = text.encode("utf-8")
+
+        size = len(text)
+        remote_name, text, compressed = self._compress_for_upload(file_name, text)
+        # Chunks are sliced from view to avoid copying
+        text = memoryview(text)
+        transfer.confirmed_bytes = 0
+        # Large files are written to temporary file, which is kept if upload is interrupted
+        resumable = len(text) >= WifiConnection.RESUMABLE_MIN_SIZE
+        success = False
+        try:
+            if not resumable:
+                success = self._put_file(remote_name, text, transfer)
             else:
+                offset = self._part_size(remote_name + ".part") if self._resume_offset(remote_name, text) else 0
+                if offset == len(text):
+                    # Only renaming of complete temporary file is left, e.g. it timed out before
+                    transfer.confirmed_bytes = offset
+                    success = True
+                elif 0 < offset < len(text):
+                    success = self._put_file(remote_name + ".tail", text[offset:], transfer, offset)
+                else:
+                    offset = 0
+                    success = self._put_file(remote_name + ".part", text, transfer)
+                success = success and self._finish_part(remote_name, len(text) - offset if offset else 0)
+
+            if not success:
                 transfer.mark_error()
+            elif compressed and not self._decompress_uploaded(file_name, size):
+                transfer.mark_error("Decompression on device failed.")
+            else:
+                self._cache_file_written(file_name, size)
+                transfer.mark_finished()
+        except TimeoutError:
+            transfer.mark_error()
         except ConnectionResetError:
             transfer.mark_error("Connection was reset.")
         except ConnectionError:
@@ -270,8 +331,10 @@ class WifiConnection(Connection):
                 "".join(traceback.format_tb(generalException.__traceback__))
             )
             transfer.mark_error(info)
-        finally:
-            self.ws.recv_timeout = original_timeout
 
-        self._auto_read_enabled = True
-        self._auto_reader_lock.release()
+        if resumable:
+            if success:
+                self._forget_partial_upload(remote_name)
+            else:
+                self._record_partial_upload(remote_name, text, transfer.confirmed_bytes)
+
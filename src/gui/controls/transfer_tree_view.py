@@ -1,6 +1,7 @@
 from threading import Timer
 
 from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtGui import QContextMenuEvent
 from PyQt5.QtWidgets import QAction
 from PyQt5.QtWidgets import QHeaderView
@@ -9,6 +10,8 @@ from PyQt5.QtWidgets import QTreeView
 
 
 class TransferTreeView(QTreeView):
+    transfer_changed_requested = pyqtSignal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
@@ -17,8 +20,7 @@ class TransferTreeView(QTreeView):
         header.sectionDoubleClicked.connect(self._header_double_clicked_handler)
 
         self._add_menu_action("Transfer", self._transfer_handler)
-        # TODO: Implement
-        # self._add_menu_action("Transfer changed", self._transfer_changed_handler)
+        self._add_menu_action("Transfer changed", self._transfer_changed_handler)
         self.context_menu.addSeparator()
         self._destination_menu_action = self._add_menu_action(
             "Set as destination", self._set_transfer_directory_handler)
@@ -38,7 +40,7 @@ class TransferTreeView(QTreeView):
         pass
 
     def _transfer_changed_handler(self):
-        pass
+        self.transfer_changed_requested.emit()
 
     def _set_transfer_directory_handler(self):
         pass
@@ -1,12 +1,13 @@
 import os
 import subprocess
 
-from PyQt5.QtCore import QStringListModel, QModelIndex, Qt, QItemSelectionModel, QEventLoop
+from PyQt5.QtCore import QModelIndex, Qt, QItemSelectionModel, QEventLoop
 from PyQt5.QtWidgets import QApplication, QMainWindow, QFileSystemModel, \
     QFileDialog, QInputDialog, QLineEdit, QMessageBox, QHeaderView
 
 from gui.mainwindow import Ui_MainWindow
 from src.connection.baud_options import BaudOptions
+from src.connection.connection import Connection
 from src.connection.connection_scanner import ConnectionScanner
 from src.connection.serial_connection import SerialConnection
 from src.connection.terminal import Terminal
@@ -15,11 +16,13 @@ from src.gui.about_dialog import AboutDialog
 from src.gui.code_edit_dialog import CodeEditDialog
 from src.gui.file_transfer_dialog import FileTransferDialog
 from src.gui.flash_dialog import FlashDialog
+from src.gui.remote_file_model import RemoteFileModel
 from src.gui.settings_dialog import SettingsDialog
 from src.gui.terminal_dialog import TerminalDialog
 from src.gui.wifi_preset_dialog import WiFiPresetDialog
 from src.helpers.ip_helper import IpHelper
-from src.logic.file_transfer import FileTransfer
+from src.logic.file_sync import FileSync
+from src.logic.file_transfer import FileTransfer, FileSink
 from src.utility.exceptions import PasswordException, NewPasswordException, OperationError
 from src.utility.settings import Settings
 
@@ -42,6 +45,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self._root_dir = Settings().root_dir
         self._mcu_files_model = None
         self._terminal = Terminal()
+        if self._terminal.log_file_error:
+            QMessageBox.warning(self, "Terminal log", "{}\nTemporary file is used instead.".format(
+                self._terminal.log_file_error))
         self._terminal_dialog = None
         self._code_editor = None
         self._flash_dialog = None
@@ -71,9 +77,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.update_file_tree()
 
-        self.listButton.clicked.connect(self.list_mcu_files)
-        self.mcuFilesListView.clicked.connect(self.mcu_file_selection_changed)
-        self.mcuFilesListView.doubleClicked.connect(self.read_mcu_file)
+        self.listButton.clicked.connect(self.refresh_mcu_files)
+        self.mcuFilesTreeView.clicked.connect(self.mcu_file_selection_changed)
+        self.mcuFilesTreeView.doubleClicked.connect(self.read_mcu_file)
         self.executeButton.clicked.connect(self.execute_mcu_code)
         self.removeButton.clicked.connect(self.remove_file)
         self.localPathEdit.setText(self._root_dir)
@@ -87,6 +93,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.autoTransferCheckBox.setChecked(Settings().auto_transfer)
 
         self.transferToMcuButton.clicked.connect(self.transfer_to_mcu)
+        self.localFilesTreeView.transfer_changed_requested.connect(self.transfer_changed_to_mcu)
         self.transferToPcButton.clicked.connect(self.transfer_to_pc)
 
         self.disconnected()
@@ -155,7 +162,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.connectionComboBox.setEnabled(True)
         self.baudComboBox.setEnabled(True)
         self.refreshButton.setEnabled(True)
-        self.mcuFilesListView.setEnabled(False)
+        self.mcuFilesTreeView.setEnabled(False)
         self.executeButton.setEnabled(False)
         self.removeButton.setEnabled(False)
         self.actionTerminal.setEnabled(False)
@@ -177,7 +184,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.connectionComboBox.setEnabled(False)
         self.baudComboBox.setEnabled(False)
         self.refreshButton.setEnabled(False)
-        self.mcuFilesListView.setEnabled(True)
+        self.mcuFilesTreeView.setEnabled(True)
         self.actionTerminal.setEnabled(True)
         if isinstance(self._connection, SerialConnection):
             self.actionUpload.setEnabled(True)
@@ -215,43 +222,98 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             file_list = None
             return False
 
+    def refresh_mcu_files(self):
+        self._show_mcu_files(True)
+
     def list_mcu_files(self):
-        file_list = []
+        self._show_mcu_files(False)
+
+    def _show_mcu_files(self, refresh):
+        model = self._mcu_files_model
+        if model is None or model.connection is not self._connection:
+            model = RemoteFileModel(self._connection)
+            expanded = []
+        else:
+            expanded = self._expanded_mcu_directories()
+
         try:
-            file_list = self._connection.list_files()
+            # Device is listed only if nothing is cached, subdirectories are listed when expanded
+            model.refresh(refresh)
         except OperationError:
             QMessageBox().critical(self, "Operation failed", "Could not list files.", QMessageBox.Ok)
             return
 
-        self._mcu_files_model = QStringListModel()
-
-        for file in file_list:
-            idx = self._mcu_files_model.rowCount()
-            self._mcu_files_model.insertRow(idx)
-            self._mcu_files_model.setData(self._mcu_files_model.index(idx), file)
-
-        self.mcuFilesListView.setModel(self._mcu_files_model)
+        if model is not self._mcu_files_model:
+            if self._mcu_files_model is not None:
+                # View doesn't delete selection model of replaced model
+                selection_model = self.mcuFilesTreeView.selectionModel()
+                selection_model.selectionChanged.disconnect(self.mcu_file_selection_changed)
+                selection_model.deleteLater()
+                self._mcu_files_model.fetch_failed.disconnect(self._mcu_directory_fetch_failed)
+            self._mcu_files_model = model
+            self.mcuFilesTreeView.setModel(model)
+            self.mcuFilesTreeView.selectionModel().selectionChanged.connect(self.mcu_file_selection_changed)
+            model.fetch_failed.connect(self._mcu_directory_fetch_failed)
+        for path in expanded:
+            self.mcuFilesTreeView.expand(model.path_index(path))
         self.mcu_file_selection_changed()
 
+    def _mcu_directory_fetch_failed(self, path):
+        # Listing again from here would fail the same way
+        self.mcuFilesTreeView.collapse(self._mcu_files_model.path_index(path, fetch=False))
+        QMessageBox().critical(self, "Operation failed", "Could not list files in {}.".format(path), QMessageBox.Ok)
+
+    def _expanded_mcu_directories(self):
+        """Returns paths of expanded directories, parents first"""
+        model = self._mcu_files_model
+        expanded = []
+        pending = [QModelIndex()]
+        while pending:
+            parent = pending.pop()
+            for row in range(model.rowCount(parent)):
+                idx = model.index(row, 0, parent)
+                if model.isDir(idx) and self.mcuFilesTreeView.isExpanded(idx):
+                    expanded.append(model.filePath(idx))
+                    pending.append(idx)
+        return sorted(expanded, key=lambda path: path.count("/"))
+
     def execute_mcu_code(self):
-        idx = self.mcuFilesListView.currentIndex()
+        idx = self.mcuFilesTreeView.currentIndex()
         assert isinstance(idx, QModelIndex)
-        model = self.mcuFilesListView.model()
-        assert isinstance(model, QStringListModel)
+        model = self.mcuFilesTreeView.model()
+        assert isinstance(model, RemoteFileModel)
         file_name = model.data(idx, Qt.EditRole)
         self._connection.run_file(file_name)
 
+    def get_mcu_selection(self):
+        """Returns remote paths of selected entries, entries inside of selected directories are left out"""
+        model = self.mcuFilesTreeView.model()
+        assert isinstance(model, RemoteFileModel)
+        paths = [model.filePath(idx) for idx in self.mcuFilesTreeView.selectedIndexes() if idx.column() == 0]
+        return [path for path in paths if not any(path.startswith(other + "/") for other in paths)]
+
     def remove_file(self):
-        idx = self.mcuFilesListView.currentIndex()
-        assert isinstance(idx, QModelIndex)
-        model = self.mcuFilesListView.model()
-        assert isinstance(model, QStringListModel)
-        file_name = model.data(idx, Qt.EditRole)
+        file_names = self.get_mcu_selection()
+        if not file_names:
+            return
+        dir_names = [name for name in file_names if self._mcu_files_model.isDir(self._mcu_files_model.path_index(name))]
+        if dir_names:
+            ret = QMessageBox.question(self, "Remove folders",
+                                       "Remove folders {} with all their content?".format(", ".join(dir_names)),
+                                       QMessageBox.Yes | QMessageBox.No)
+            if ret != QMessageBox.Yes:
+                return
+
         try:
-            self._connection.remove_file(file_name)
+            results = self._connection.remove_files(file_names, recursive=True)
         except OperationError:
-            QMessageBox().critical(self, "Operation failed", "Could not remove the file.", QMessageBox.Ok)
-            return
+            QMessageBox().critical(self, "Operation failed", "Could not remove the files.", QMessageBox.Ok)
+        else:
+            failed = [name for name in file_names if not results.get(name)]
+            if failed:
+                QMessageBox().critical(self, "Operation failed", "Could not remove:\n" + "\n".join(failed),
+                                       QMessageBox.Ok)
+        # Some entries could have been removed even if others failed
         self.list_mcu_files()
 
     def ask_for_password(self, title, label="Password"):
@@ -368,16 +430,14 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                                                           " in editor, but can still be transferred.")
 
     def mcu_file_selection_changed(self):
-        idx = self.mcuFilesListView.currentIndex()
+        idx = self.mcuFilesTreeView.currentIndex()
         assert isinstance(idx, QModelIndex)
-        if idx.row() >= 0:
-            self.executeButton.setEnabled(True)
-            self.removeButton.setEnabled(True)
-            self.transferToPcButton.setEnabled(True)
-        else:
-            self.executeButton.setEnabled(False)
-            self.removeButton.setEnabled(False)
-            self.transferToPcButton.setEnabled(False)
+        selection = self.get_mcu_selection()
+        # Only single file can be executed or transferred, any number of entries can be removed
+        single_file = len(selection) == 1 and idx.row() >= 0 and not self._mcu_files_model.isDir(idx)
+        self.executeButton.setEnabled(single_file)
+        self.transferToPcButton.setEnabled(single_file)
+        self.removeButton.setEnabled(len(selection) > 0)
 
     def get_local_file_selection(self):
         """Returns absolute paths for selected local files"""
@@ -395,11 +455,30 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         # Return absolute paths
         return [model.filePath(idx) for idx in indices]
 
+    def get_local_upload_selection(self):
+        """Returns absolute paths for selected local files and all files in selected directories"""
+        model = self.localFilesTreeView.model()
+        assert isinstance(model, QFileSystemModel)
+
+        paths = []
+        for idx in self.localFilesTreeView.selectedIndexes():
+            if idx.column() != 0:
+                continue
+            path = model.filePath(idx)
+            if not model.isDir(idx):
+                paths.append(path)
+                continue
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                paths += [dir_path.replace(os.sep, "/") + "/" + name for name in sorted(file_names)]
+        # Files in selected directory can also be selected on their own
+        return list(dict.fromkeys(paths))
+
     def local_file_selection_changed(self):
         self.update_compile_button()
         local_file_paths = self.get_local_file_selection()
         if len(local_file_paths) == 1:
-            self.remoteNameEdit.setText(local_file_paths[0].rsplit("/", 1)[1])
+            self.remoteNameEdit.setText(Connection._get_remote_file_name(local_file_paths[0], self._root_dir))
         else:
             self.remoteNameEdit.setText("")
 
@@ -476,8 +555,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def read_mcu_file(self, idx):
         assert isinstance(idx, QModelIndex)
-        model = self.mcuFilesListView.model()
-        assert isinstance(model, QStringListModel)
+        model = self.mcuFilesTreeView.model()
+        assert isinstance(model, RemoteFileModel)
+        if model.isDir(idx):
+            # Directory is expanded instead
+            return
         file_name = model.data(idx, Qt.EditRole)
         if not file_name.endswith(".py"):
             QMessageBox.information(self, "Unknown file", "Files without .py ending won't open"
@@ -496,7 +578,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self._connection.upload_transfer_files(progress_dlg.transfer)
 
     def transfer_to_mcu(self):
-        local_file_paths = self.get_local_file_selection()
+        local_file_paths = self.get_local_upload_selection()
+        if not local_file_paths:
+            return
 
         progress_dlg = FileTransferDialog(FileTransferDialog.UPLOAD)
         progress_dlg.finished.connect(self.list_mcu_files)
@@ -505,39 +589,63 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         # Handle single file transfer
         if len(local_file_paths) == 1:
             local_path = local_file_paths[0]
-            remote_path = self.remoteNameEdit.text()
-            with open(local_path, "rb") as f:
-                content = f.read()
-            self._connection.write_file(remote_path, content, progress_dlg.transfer)
+            remote_path = self.remoteNameEdit.text() or Connection._get_remote_file_name(local_path, self._root_dir)
+            self._connection.write_local_file(local_path, remote_path, progress_dlg.transfer)
             return
 
         # Batch file transfer
+        self._transfer_files_to_mcu(local_file_paths, progress_dlg)
+
+    def _transfer_files_to_mcu(self, local_file_paths, progress_dlg):
         progress_dlg.enable_cancel()
         progress_dlg.transfer.set_file_count(len(local_file_paths))
-        self._connection.write_files(local_file_paths, progress_dlg.transfer)
+        self._connection.write_files(local_file_paths, progress_dlg.transfer, self._root_dir)
 
-    def finished_transfer_to_pc(self, file_path, transfer):
-        if not transfer.read_result.binary_data:
+    def transfer_changed_to_mcu(self):
+        if self._connection is None or not self._connection.is_connected():
+            return
+
+        local_file_paths = self.get_local_upload_selection()
+        if not local_file_paths:
             return
 
         try:
-            with open(file_path, "wb") as file:
-                file.write(transfer.read_result.binary_data)
+            changed_file_paths = FileSync.changed_files(self._connection, local_file_paths, self._root_dir)
+        except OperationError:
+            QMessageBox().critical(self, "Operation failed", "Could not compare files with device.", QMessageBox.Ok)
+            return
         except IOError:
-            QMessageBox.critical(self, "Save operation failed", "Couldn't save the file. Check path and permissions.")
+            QMessageBox().critical(self, "Operation failed", "Could not read local files.", QMessageBox.Ok)
+            return
+
+        if not changed_file_paths:
+            QMessageBox.information(self, "Transfer changed", "All selected files are up to date.")
+            return
+
+        progress_dlg = FileTransferDialog(FileTransferDialog.UPLOAD)
+        progress_dlg.finished.connect(self.list_mcu_files)
+        progress_dlg.show()
+        self._transfer_files_to_mcu(changed_file_paths, progress_dlg)
 
     def transfer_to_pc(self):
-        idx = self.mcuFilesListView.currentIndex()
+        idx = self.mcuFilesTreeView.currentIndex()
         assert isinstance(idx, QModelIndex)
-        model = self.mcuFilesListView.model()
-        assert isinstance(model, QStringListModel)
+        model = self.mcuFilesTreeView.model()
+        assert isinstance(model, RemoteFileModel)
         remote_path = model.data(idx, Qt.EditRole)
         local_path = self.localPathEdit.text() + "/" + remote_path
 
+        # Data are written to disk as they arrive, target file is replaced only if transfer succeeds
+        try:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            sink = FileSink(local_path)
+        except IOError:
+            QMessageBox.critical(self, "Save operation failed", "Couldn't save the file. Check path and permissions.")
+            return
+
         progress_dlg = FileTransferDialog(FileTransferDialog.DOWNLOAD)
-        progress_dlg.finished.connect(lambda: self.finished_transfer_to_pc(local_path, progress_dlg.transfer))
         progress_dlg.show()
-        self._connection.read_file(remote_path, progress_dlg.transfer)
+        self._connection.read_file(remote_path, progress_dlg.transfer, sink)
 
     def open_terminal(self):
         if self._terminal_dialog is not None:
@@ -0,0 +1,156 @@
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt, pyqtSignal
+
+from src.utility.exceptions import OperationError
+
+
+class _Node:
+    def __init__(self, entry, parent, row):
+        self.entry = entry
+        self.parent = parent
+        self.row = row
+        # None until directory content is fetched
+        self.children = None
+
+    @property
+    def path(self):
+        return self.entry.path if self.entry else ""
+
+    @property
+    def is_dir(self):
+        return self.entry is None or self.entry.is_dir
+
+
+class RemoteFileModel(QAbstractItemModel):
+    """Device file system, content of directory is listed only when it's expanded.
+
+    Edit role of any column holds remote path of the entry.
+    """
+
+    COLUMNS = ["Name", "Size"]
+
+    # Emitted with remote path of directory that couldn't be listed, it is listed again when expanded next time
+    fetch_failed = pyqtSignal(str)
+
+    def __init__(self, connection, parent=None):
+        super().__init__(parent)
+        self._connection = connection
+        self._root = _Node(None, None, 0)
+
+    @property
+    def connection(self):
+        return self._connection
+
+    def refresh(self, reload=False):
+        """Rebuilds model at once, device is listed again only if reload is set or nothing is cached.
+
+        :raises OperationError: If root directory couldn't be listed
+        """
+        self.beginResetModel()
+        self._root = _Node(None, None, 0)
+        try:
+            self._root.children = self._fetch(self._root, reload)
+        except OperationError:
+            # Empty root isn't fetched again by view, it is listed on next refresh
+            self._root.children = []
+            raise
+        finally:
+            self.endResetModel()
+
+    def _fetch(self, node, reload=False):
+        entries = self._connection.remote_directory(node.path, reload)
+        # Directories first, then files, both by name
+        entries = sorted(entries, key=lambda entry: (not entry.is_dir, entry.name.lower()))
+        return [_Node(entry, node, row) for row, entry in enumerate(entries)]
+
+    def _node(self, index):
+        return index.internalPointer() if index.isValid() else self._root
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self._node(parent)
+        if not node.children or not 0 <= row < len(node.children) or not 0 <= column < len(self.COLUMNS):
+            return QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().parent
+        if parent is self._root:
+            return QModelIndex()
+        return self.createIndex(parent.row, 0, parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        children = self._node(parent).children
+        return len(children) if children else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.COLUMNS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self._node(parent)
+        # Unknown content is assumed to exist, so that directory can be expanded
+        return node.is_dir and (node.children is None or len(node.children) > 0)
+
+    def canFetchMore(self, parent):
+        node = self._node(parent)
+        return node.is_dir and node.children is None
+
+    def fetchMore(self, parent):
+        node = self._node(parent)
+        try:
+            children = self._fetch(node)
+        except OperationError:
+            self.fetch_failed.emit(node.path)
+            return
+        if children:
+            self.beginInsertRows(parent, 0, len(children) - 1)
+            node.children = children
+            self.endInsertRows()
+        else:
+            node.children = children
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        entry = index.internalPointer().entry
+        if role == Qt.EditRole:
+            return entry.path
+        if role == Qt.DisplayRole:
+            if index.column() == 0:
+                return entry.name
+            return "" if entry.is_dir else str(entry.size)
+        if role == Qt.TextAlignmentRole and index.column() == 1:
+            return Qt.AlignRight | Qt.AlignVCenter
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def isDir(self, index):
+        return index.isValid() and index.internalPointer().is_dir
+
+    def filePath(self, index):
+        return self._node(index).path
+
+    def path_index(self, path, fetch=True):
+        """Returns index of entry with path, directories on the way are fetched if needed and fetch is set"""
+        node = self._root
+        index = QModelIndex()
+        if not path:
+            return index
+        for depth in range(path.count("/") + 1):
+            if node.children is None and fetch:
+                self.fetchMore(index)
+            if node.children is None:
+                return QModelIndex()
+            prefix = "/".join(path.split("/")[:depth + 1])
+            match = [child for child in node.children if child.path == prefix]
+            if not match:
+                return QModelIndex()
+            node = match[0]
+            index = self.createIndex(node.row, 0, node)
+        return index
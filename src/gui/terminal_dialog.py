@@ -1,11 +1,14 @@
+import time
+
 from PyQt5.QtCore import QEvent
-from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer
 from PyQt5.QtGui import QKeyEvent, QHideEvent, QFontDatabase, QTextCursor
 from PyQt5.QtGui import QKeySequence
 from PyQt5.QtWidgets import QDialog, QScrollBar
 
 from gui.terminal import Ui_TerminalDialog
 from src.helpers.qt_helper import QtHelper
+from src.logic.terminal_processor import TerminalProcessor
 from src.utility.settings import Settings
 from src.utility.signal_interface import Listener
 
@@ -13,11 +16,19 @@ __author__ = "Ivan Sevcik"
 
 
 class TerminalDialog(QDialog, Ui_TerminalDialog):
+    # Output that arrives faster is batched, so that flooding device doesn't freeze GUI
+    MAX_UPDATES_PER_SECOND = 25
+    # Oldest lines are removed from output view above this count
+    MAX_BLOCK_COUNT = 10000
+    # Number of older lines loaded from scrollback when view is scrolled to the top
+    HISTORY_PAGE_LINES = 500
+
     _update_content_signal = pyqtSignal()
 
     def __init__(self, parent, connection, terminal):
         super(TerminalDialog, self).__init__(None, Qt.WindowCloseButtonHint)
         self.setupUi(self)
+        self._search_line = -1
 
         self.setWindowFlags(Qt.Window)
         geometry = Settings().retrieve_geometry("terminal")
@@ -27,8 +38,10 @@ class TerminalDialog(QDialog, Ui_TerminalDialog):
         self.connection = connection
         self.terminal = terminal
         self._auto_scroll = True  # TODO: Settings?
+        self._update_pending = False
+        self._last_update = 0
         self.terminal_listener = Listener(self.emit_update_content)
-        self._update_content_signal.connect(self.update_content)
+        self._update_content_signal.connect(self._schedule_update)
         self.terminal.add_event.connect(self.terminal_listener)
 
         self.outputTextEdit.installEventFilter(self)
@@ -36,6 +49,7 @@ class TerminalDialog(QDialog, Ui_TerminalDialog):
         self.outputTextEdit.verticalScrollBar().sliderReleased.connect(self._scroll_released)
         self.outputTextEdit.verticalScrollBar().installEventFilter(self)
         self.inputTextBox.installEventFilter(self)
+        self.searchLineEdit.installEventFilter(self)
         self.clearButton.clicked.connect(self.clear_content)
         self.sendButton.clicked.connect(self.send_input)
 
@@ -51,36 +65,120 @@ class TerminalDialog(QDialog, Ui_TerminalDialog):
         self.autoscrollCheckBox.setChecked(self._auto_scroll)
         self.autoscrollCheckBox.stateChanged.connect(self._auto_scroll_changed)
 
-        self.terminal.read()
-        self.outputTextEdit.setText(TerminalDialog.process_backspaces(self.terminal.history))
+        self._processor = TerminalProcessor()
+        # Scrollback index of the last line in view
+        self._last_line = 0
+        # View shows older part of scrollback instead of following new output
+        self._detached = False
+        self._show_tail()
+        self.outputTextEdit.verticalScrollBar().valueChanged.connect(self._scrolled)
         self._input_history_index = 0
 
     def _stop_scrolling(self):
         self._auto_scroll = False
 
     def _scroll_released(self):
+        scrollbar = self.outputTextEdit.verticalScrollBar()
+        assert isinstance(scrollbar, QScrollBar)
+        at_end = scrollbar.value() >= scrollbar.maximum()
+        if self._detached:
+            if at_end:
+                # End of shown history was reached, follow newest output again
+                self.autoscrollCheckBox.setChecked(True)
+                if self._detached:
+                    self._auto_scroll = True
+                    self._show_tail()
+            return
+
         if not self.autoscrollCheckBox.isChecked():
             self._auto_scroll = False
             return
 
-        scrollbar = self.outputTextEdit.verticalScrollBar()
-        assert isinstance(scrollbar, QScrollBar)
-        current_scroll = scrollbar.value()
-        self._auto_scroll = current_scroll >= scrollbar.maximum()
+        self._auto_scroll = at_end
 
     def _auto_scroll_changed(self, state):
         self._auto_scroll = self.autoscrollCheckBox.isChecked()
+        if self._auto_scroll and self._detached:
+            self._show_tail()
+
+    def _show_tail(self):
+        """Shows newest output and follows it from now on"""
+        self._processor.reset()
+        first_line, text = self.terminal.read_tail(TerminalDialog.MAX_BLOCK_COUNT)
+        _, text = self._processor.process(text)
+        self._last_line = first_line + text.count("\n")
+        self._detached = False
+        self.outputTextEdit.document().setMaximumBlockCount(TerminalDialog.MAX_BLOCK_COUNT)
+        self.outputTextEdit.setPlainText(text)
+        self.outputTextEdit.moveCursor(QTextCursor.End)
+
+    def _show_history(self, line):
+        """Shows part of scrollback around line, new output isn't shown until auto-scroll is enabled"""
+        start = max(self.terminal.first_line, line - TerminalDialog.HISTORY_PAGE_LINES)
+        _, text = TerminalProcessor().process(
+            self.terminal.scrollback.text(start, line + TerminalDialog.HISTORY_PAGE_LINES))
+        self._last_line = start + text.count("\n")
+        self._detached = True
+        self._auto_scroll = False
+        # View follows output again once the box is checked
+        self.autoscrollCheckBox.setChecked(False)
+        self.outputTextEdit.document().setMaximumBlockCount(0)
+        self.outputTextEdit.setPlainText(text)
+
+    def _first_line(self):
+        """Returns scrollback index of the first line in view"""
+        return self._last_line - self.outputTextEdit.document().blockCount() + 1
+
+    def _scrolled(self, value):
+        if value == 0 and self.outputTextEdit.verticalScrollBar().maximum() > 0:
+            self._load_older(self._first_line() - TerminalDialog.HISTORY_PAGE_LINES)
 
-    @staticmethod
-    def process_backspaces(text):
-        processed = ""
-        for x in text:
-            # Delete character there are any characters that are not backspaces
-            if x == "\b" and processed and processed[-1:] != "\b":
-                processed = processed[:-1]
-            else:
-                processed += x
-        return processed
+    def _load_older(self, start):
+        """Inserts lines from scrollback starting at start in front of lines that are in view"""
+        first = self._first_line()
+        start = max(start, self.terminal.first_line)
+        if start >= first:
+            return
+        # Lines are complete, so they don't depend on processing of output around them
+        _, text = TerminalProcessor().process(self.terminal.scrollback.text(start, first))
+        # Loaded history would be removed right away if block count was limited
+        self.outputTextEdit.document().setMaximumBlockCount(0)
+
+        scrollbar = self.outputTextEdit.verticalScrollBar()
+        distance_to_end = scrollbar.maximum() - scrollbar.value()
+        cursor = QTextCursor(self.outputTextEdit.document())
+        cursor.movePosition(QTextCursor.Start)
+        cursor.insertText(text)
+        scrollbar.setValue(scrollbar.maximum() - distance_to_end)
+
+    def search_next(self):
+        text = self.searchLineEdit.text()
+        if not text:
+            return
+        scrollback = self.terminal.scrollback
+        line = scrollback.find(text, max(self._search_line + 1, self.terminal.first_line))
+        if line < 0:
+            # Continue from the beginning
+            line = scrollback.find(text, self.terminal.first_line)
+        if line < 0:
+            return
+        self._search_line = line
+        if self._first_line() - TerminalDialog.HISTORY_PAGE_LINES <= line <= self._last_line:
+            self._load_older(line)
+        else:
+            self._show_history(line)
+
+        block = self.outputTextEdit.document().findBlockByNumber(line - self._first_line())
+        cursor = QTextCursor(block)
+        column = block.text().find(text)
+        if column >= 0:
+            cursor.movePosition(QTextCursor.Right, QTextCursor.MoveAnchor, column)
+            cursor.movePosition(QTextCursor.Right, QTextCursor.KeepAnchor, len(text))
+        else:
+            cursor.movePosition(QTextCursor.EndOfBlock, QTextCursor.KeepAnchor)
+        self._auto_scroll = False
+        self.outputTextEdit.setTextCursor(cursor)
+        self.outputTextEdit.ensureCursorVisible()
 
     def closeEvent(self, event):
         Settings().update_geometry("terminal", self.saveGeometry())
@@ -91,17 +189,34 @@ class TerminalDialog(QDialog, Ui_TerminalDialog):
 
     def emit_update_content(self):
         """Update content indirection so that this can be called in multi-threaded environment"""
+        # Content that arrives before scheduled update is shown by it
+        if self._update_pending:
+            return
+        self._update_pending = True
         self._update_content_signal.emit()
 
+    def _schedule_update(self):
+        interval = 1.0 / TerminalDialog.MAX_UPDATES_PER_SECOND
+        delay = self._last_update + interval - time.time()
+        QTimer.singleShot(max(0, int(delay * 1000)), self.update_content)
+
     def clear_content(self):
-        self.outputTextEdit.clear()
         self.terminal.clear()
+        self._search_line = -1
+        self._show_tail()
 
     def update_content(self):
-        new_content = self.terminal.read()
-        new_content = self.process_backspaces(new_content)
-        if not new_content:
+        # Content added from now on needs another update
+        self._update_pending = False
+        self._last_update = time.time()
+        if self._detached:
+            # Output stays in scrollback, it is shown when view follows it again
+            self.terminal.read()
+            return
+        delete, new_content = self._processor.process(self.terminal.read())
+        if not delete and not new_content:
             return
+        self._last_line += new_content.count("\n")
 
         scrollbar = self.outputTextEdit.verticalScrollBar()
         assert isinstance(scrollbar, QScrollBar)
@@ -110,17 +225,19 @@ class TerminalDialog(QDialog, Ui_TerminalDialog):
 
         prev_cursor = self.outputTextEdit.textCursor()
         self.outputTextEdit.moveCursor(QTextCursor.End)
-        # Use any backspaces that were left in input to delete text
-        cut = 0
-        for x in new_content:
-            if x != "\b":
-                break
-            self.outputTextEdit.textCursor().deletePreviousChar()
-            cut += 1
-        self.outputTextEdit.insertPlainText(new_content[cut:])
+        # Part of current line which was changed by control sequences is replaced
+        if delete:
+            cursor = self.outputTextEdit.textCursor()
+            cursor.movePosition(QTextCursor.Left, QTextCursor.KeepAnchor, delete)
+            cursor.removeSelectedText()
+        self.outputTextEdit.insertPlainText(new_content)
         self.outputTextEdit.setTextCursor(prev_cursor)
 
         if self._auto_scroll:
+            # View follows output again, history loaded by scrolling up isn't kept anymore
+            document = self.outputTextEdit.document()
+            if document.maximumBlockCount() != TerminalDialog.MAX_BLOCK_COUNT:
+                document.setMaximumBlockCount(TerminalDialog.MAX_BLOCK_COUNT)
             scrollbar.setValue(scrollbar.maximum())
         else:
             scrollbar.setValue(current_scroll)
@@ -158,14 +275,19 @@ class TerminalDialog(QDialog, Ui_TerminalDialog):
             if isinstance(event, QKeyEvent):
                 if event.type() == QEvent.KeyPress:
                     if event.key() == Qt.Key_Up:
-                        self.connection.send_bytes(b"\x1b[A")
+                        self.connection.send_character("\x1b[A")
                     if event.key() == Qt.Key_Down:
-                        self.connection.send_bytes(b"\x1b[B")
+                        self.connection.send_character("\x1b[B")
                     else:
                         t = event.text()
                         if t:
                             self.connection.send_character(t)
                     return True
+        elif target == self.searchLineEdit:
+            if isinstance(event, QKeyEvent) and event.type() == QEvent.KeyPress:
+                if event.key() in (Qt.Key_Return, Qt.Key_Enter):
+                    self.search_next()
+                    return True
         elif target == self.outputTextEdit.verticalScrollBar():
             if isinstance(event, QHideEvent):
                 return True
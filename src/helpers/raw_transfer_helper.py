@@ -0,0 +1,25 @@
+class RawTransferHelper:
+    """Escaping of REPL control characters (Ctrl-C, Ctrl-D, Ctrl-E) for raw transfer mode.
+
+    Frame mark (#) is escaped too, so that it can be used to find start of frame.
+    Each escaped byte is sent as DLE (0x10) followed by the byte XOR 0x40.
+    Must match the implementation in transfer scripts.
+    """
+    _ESC = b"\x10"
+    _SPECIAL = [b"\x03", b"\x04", b"\x05", b"#"]
+
+    @staticmethod
+    def escape(data):
+        # Escape character itself has to be escaped first
+        data = bytes(data).replace(RawTransferHelper._ESC, RawTransferHelper._ESC + b"P")
+        for x in RawTransferHelper._SPECIAL:
+            data = data.replace(x, RawTransferHelper._ESC + bytes([x[0] ^ 0x40]))
+        return data
+
+    @staticmethod
+    def unescape(data):
+        data = bytes(data)
+        for x in RawTransferHelper._SPECIAL:
+            data = data.replace(RawTransferHelper._ESC + bytes([x[0] ^ 0x40]), x)
+        # Escape character itself has to be restored last
+        return data.replace(RawTransferHelper._ESC + b"P", RawTransferHelper._ESC)
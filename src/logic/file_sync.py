@@ -0,0 +1,28 @@
+import hashlib
+
+from src.connection.connection import Connection
+
+
+class FileSync:
+    @staticmethod
+    def local_hash(file_path):
+        """Returns SHA-256 hex digest of local file"""
+        h = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    @staticmethod
+    def changed_files(connection, local_file_paths, root=None):
+        """Returns local files which are missing on device or differ from their remote copy.
+
+        With root, remote copy is looked up under path relative to it, same as in upload.
+
+        :raises OperationError: If remote hashes couldn't be retrieved
+        """
+        remote_names = [Connection._get_remote_file_name(path, root) for path in local_file_paths]
+        remote_hashes = connection.hash_files(remote_names)
+
+        return [path for path, name in zip(local_file_paths, remote_names)
+                if remote_hashes.get(name) != FileSync.local_hash(path)]
@@ -1,15 +1,128 @@
+import bisect
+import mmap
+import os
+import time
+
+
+class FileSource:
+    """Memory-maps local file, so that it can be uploaded without reading it whole into memory"""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = None
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self._map)
+        except ValueError:
+            # Empty file can't be mapped
+            self.data = memoryview(b"")
+
+    def close(self):
+        try:
+            self.data.release()
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            # Views are still referenced (e.g. by traceback of failed upload),
+            # map is then closed once the last of them is garbage collected
+            pass
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class JoinedData:
+    """Several buffers that can be sliced as single one without joining them"""
+
+    def __init__(self, parts):
+        self._parts = [memoryview(x) for x in parts]
+        self._starts = []
+        self._len = 0
+        for x in self._parts:
+            self._starts.append(self._len)
+            self._len += len(x)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self._len)
+        idx = bisect.bisect_right(self._starts, start) - 1
+        pieces = []
+        while start < stop:
+            offset = start - self._starts[idx]
+            piece = self._parts[idx][offset:offset + stop - start]
+            pieces.append(piece)
+            start += len(piece)
+            idx += 1
+        if len(pieces) == 1:
+            return pieces[0]
+        return b"".join(pieces)
+
+
 class ReadResult:
     def __init__(self):
         self.binary_data = b""
 
 
+class MemorySink:
+    """Collects received data and stores them in read result once transfer succeeds"""
+
+    def __init__(self, read_result):
+        self._read_result = read_result
+        self._data = bytearray()
+
+    def write(self, data):
+        self._data += data
+
+    def commit(self):
+        self._read_result.binary_data = bytes(self._data)
+
+    def discard(self):
+        self._read_result.binary_data = None
+
+
+class FileSink:
+    """Writes received data to temporary file, which replaces target file once transfer succeeds"""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path + ".part", "wb")
+
+    def write(self, data):
+        self._file.write(data)
+
+    def commit(self):
+        self._file.close()
+        os.replace(self._path + ".part", self._path)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self._path + ".part")
+        except OSError:
+            pass
+
+
 class FileTransferError(Exception):
     pass
 
 
 class FileTransfer:
+    # Progress is signalled only after it changes by this much and this time passes,
+    # so that listeners aren't flooded when transfer goes chunk by chunk
+    PROGRESS_SIGNAL_STEP = 0.01
+    PROGRESS_SIGNAL_INTERVAL = 0.05
+
     def __init__(self, signal):
         self._progress = 0
+        self._signalled_progress = 0
+        self._signalled_time = 0
         self._file = 0
         self._file_count = 1
         self._cancel_scheduled = False
@@ -19,6 +132,8 @@ class FileTransfer:
         self._error = False
         self._signal = signal
         self.read_result = ReadResult()
+        # Number of bytes of current file that are confirmed to be written on device
+        self.confirmed_bytes = 0
 
     @property
     def progress(self):
@@ -27,7 +142,17 @@ class FileTransfer:
     @progress.setter
     def progress(self, value):
         self._progress = value
-        self._signal()
+        now = time.time()
+        if value >= 1 or value < self._signalled_progress or \
+                (value - self._signalled_progress >= FileTransfer.PROGRESS_SIGNAL_STEP and
+                 now - self._signalled_time >= FileTransfer.PROGRESS_SIGNAL_INTERVAL):
+            self._signalled_progress = value
+            self._signalled_time = now
+            self._signal()
+
+    @property
+    def file_index(self):
+        return self._file
 
     @property
     def finished(self):
@@ -39,7 +164,7 @@ class FileTransfer:
         if self._file == self._file_count:
             self._finished = True
         else:
-            self._progress = 0
+            self._progress = self._signalled_progress = 0
         self._signal()
 
     def cancel(self):
@@ -0,0 +1,16 @@
+class RemoteFile:
+    """Entry of device file system, path is relative to device working directory"""
+
+    def __init__(self, path, is_dir, size):
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+
+    @property
+    def name(self):
+        return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        """Path of directory that contains this entry, empty for working directory"""
+        return self.path.rsplit("/", 1)[0] if "/" in self.path else ""
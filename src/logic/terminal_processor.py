@@ -0,0 +1,87 @@
+class TerminalProcessor:
+    """Applies terminal control characters and escape sequences to output.
+
+    Output is processed chunk by chunk, each character only once. Only the current
+    line can be edited by control sequences, all previous lines are final. State is
+    kept between chunks, so sequences can be split anywhere.
+    """
+
+    _ESC = "\x1b"
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._line = []
+        self._col = 0
+        # Number of characters of current line that were already returned
+        self._shown = 0
+        # Started but unfinished escape sequence
+        self._escape = ""
+
+    def process(self, text):
+        """Returns number of characters to delete from end of shown text and text to append"""
+        out = []
+        delete = 0
+        # Start of current line part which has changed since it was shown
+        changed = self._shown
+        line = self._line
+
+        for c in text:
+            if self._escape:
+                self._escape += c
+                if len(self._escape) == 2 and c != "[":
+                    # Only CSI sequences are supported, others are dropped
+                    self._escape = ""
+                elif len(self._escape) > 2 and "@" <= c <= "~":
+                    changed = min(changed, self._apply_sequence(self._escape[2:-1], c))
+                    self._escape = ""
+            elif c == TerminalProcessor._ESC:
+                self._escape = c
+            elif c == "\n":
+                out.append("".join(line[changed:]))
+                out.append("\n")
+                delete += self._shown - changed
+                del line[:]
+                self._col = changed = self._shown = 0
+            elif c == "\r":
+                self._col = 0
+            elif c == "\b":
+                self._col = max(0, self._col - 1)
+            else:
+                if self._col < len(line):
+                    line[self._col] = c
+                    changed = min(changed, self._col)
+                else:
+                    line.extend(" " * (self._col - len(line)))
+                    line.append(c)
+                self._col += 1
+
+        out.append("".join(line[changed:]))
+        delete += self._shown - changed
+        self._shown = len(line)
+        return delete, "".join(out)
+
+    def _apply_sequence(self, params, command):
+        """Applies CSI sequence, returns first column of current line that it changed"""
+        line = self._line
+        try:
+            n = int(params or 1)
+        except ValueError:
+            # Multiple parameters (e.g. colors) aren't supported
+            return len(line)
+
+        if command == "D":
+            self._col = max(0, self._col - n)
+        elif command == "C":
+            self._col += n
+        elif command == "K":
+            mode = int(params or 0)
+            if mode == 0:
+                start = min(self._col, len(line))
+                del line[start:]
+                return start
+            elif mode == 2:
+                del line[:]
+                return 0
+        return len(line)
@@ -19,6 +19,9 @@ class Settings(metaclass=Singleton):
         self.send_sleep = 0.1
         self.read_sleep = 0.1
         self.use_transfer_scripts = True
+        self.transfer_window_size = 4
+        self.raw_transfer = True
+        self.compress_transfer = False
         self.external_transfer_scripts_folder = None
         self.wifi_presets = []
         self.python_flash_executable = None
@@ -30,6 +33,9 @@ class Settings(metaclass=Singleton):
         self.new_line_key = QKeySequence(Qt.SHIFT + Qt.Key_Return, Qt.SHIFT + Qt.Key_Enter)
         self.send_key = QKeySequence(Qt.Key_Return, Qt.Key_Enter)
         self.terminal_tab_spaces = 4
+        self.terminal_history_size = 1000000
+        # Terminal output is appended to this file, temporary file is used if it isn't set
+        self.terminal_log_file = None
         self.mpy_cross_path = None
         self.preferred_port = None
         self.auto_transfer = False
@@ -0,0 +1,72 @@
+import os
+import unittest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QModelIndex
+from PyQt5.QtWidgets import QApplication, QTreeView
+
+from src.gui.remote_file_model import RemoteFileModel
+from src.logic.remote_file import RemoteFile
+from src.utility.exceptions import OperationError
+
+
+class FailingConnection:
+    """Lists only directories from entries, others fail like unreachable device"""
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.list_count = 0
+
+    def remote_directory(self, path, reload=False):
+        self.list_count += 1
+        if path not in self.entries:
+            raise OperationError()
+        return self.entries[path]
+
+
+class TestRemoteFileModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication([])
+
+    def test_failed_root_refresh(self):
+        connection = FailingConnection()
+        model = RemoteFileModel(connection)
+        failed = []
+        model.fetch_failed.connect(lambda path: failed.append(model.path_index(path, fetch=False)))
+        view = QTreeView()
+        view.setModel(model)
+
+        with self.assertRaises(OperationError):
+            model.refresh(True)
+        view.show()
+        self.app.processEvents()
+
+        # Root isn't listed again until next refresh
+        self.assertFalse(model.canFetchMore(QModelIndex()))
+        self.assertEqual(model.rowCount(), 0)
+        self.assertEqual(connection.list_count, 1)
+        self.assertEqual(failed, [])
+
+    def test_failed_directory_fetch_is_retried(self):
+        connection = FailingConnection({"": [RemoteFile("lib", True, 0)]})
+        model = RemoteFileModel(connection)
+        failed = []
+        model.fetch_failed.connect(lambda path: failed.append(model.path_index(path, fetch=False)))
+        model.refresh()
+
+        index = model.index(0, 0)
+        model.fetchMore(index)
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0], index)
+        self.assertTrue(model.canFetchMore(index))
+
+        connection.entries["lib"] = [RemoteFile("lib/x.py", False, 3)]
+        model.fetchMore(index)
+        self.assertEqual(model.rowCount(index), 1)
+        self.assertEqual(model.path_index("lib/x.py", fetch=False).data(), "x.py")
+
+
+if __name__ == "__main__":
+    unittest.main()